@@ -14,6 +14,8 @@ COEF_A = 360.6
 COEF_B = 1.1941
 BANDA_RED_IDX = 3
 BANDA_GREEN_IDX = 2
+MVLF_COEF_ANGULAR = 13147.5532
+MVLF_INTERCEPTO = -557.5606
 
 # --- Funções geoespaciais ---
 def carregar_e_calcular_ndvi(tiff_path, shp_path):
@@ -47,9 +49,7 @@ def carregar_e_calcular_ndvi(tiff_path, shp_path):
         return red_raw, ndvi
 
 # --- Função de MVLF ---
-def calcular_mvlf(ndvi_p25):
-    coef_angular = 13147.5532
-    intercepto = -557.5606
+def calcular_mvlf(ndvi_p25, coef_angular=MVLF_COEF_ANGULAR, intercepto=MVLF_INTERCEPTO):
     mvlf = max(0, coef_angular * ndvi_p25 + intercepto)
     return mvlf
 
@@ -69,7 +69,7 @@ def processar_e_plotar(tiff_path, shp_path):
 
     # --- Criação do gráfico ---
     ndvi_simulado = np.linspace(0, 1, 50)
-    mvlf_simulado = 13147.5532 * ndvi_simulado - 557.5606
+    mvlf_simulado = MVLF_COEF_ANGULAR * ndvi_simulado + MVLF_INTERCEPTO
 
     plt.figure(figsize=(8,6))
     plt.plot(ndvi_simulado, mvlf_simulado, 'r-', label="Regressão MVLF")
@@ -5,25 +5,51 @@ import re
 import json
 import tkinter as tk
 from tkinter import filedialog, messagebox
-from tkinter.ttk import Progressbar, Separator, Checkbutton, Button, Label, Style, Frame, Entry
+from tkinter.ttk import Progressbar, Separator, Checkbutton, Button, Label, Style, Frame, Entry, Spinbox, Combobox
 import geopandas as gpd
 import rasterio
-import rasterio.mask
 from rasterio.transform import array_bounds
-from rasterio.enums import Resampling
+from rasterio.windows import Window
+from rasterio.windows import bounds as limites_janela, transform as transform_janela
+from rasterio.coords import BoundingBox
+from rasterio.features import geometry_mask
+from rasterio.enums import Resampling, MaskFlags
 import numpy as np
 import matplotlib.pyplot as plt
-from shapely.geometry import mapping
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from shapely.geometry import mapping, shape, box
+from shapely import STRtree
+import fiona
+from rasterio.crs import CRS
+from rasterio.warp import transform_bounds
+from affine import Affine
 from shapely.ops import unary_union
 from skimage import exposure
+from skimage.util import img_as_uint
 from skimage.transform import resize
 import pandas as pd
 import traceback
 from datetime import datetime
 from PIL import Image, ImageTk 
 import io
+from collections import OrderedDict
 from pathlib import Path # Biblioteca para lidar com caminhos de forma robusta
-import tempfile
+import argparse
+import shutil
+import threading
+import queue
+import time
+import math
+import hashlib
+import csv
+import multiprocessing
+import signal
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from função import calcular_mvlf, MVLF_COEF_ANGULAR, MVLF_INTERCEPTO
 # =========================
 # ARQUIVO DE CONFIGURAÇÃO
 # =========================
@@ -39,6 +65,85 @@ BANDAS_GREEN_IDX = 2
 BANDAS_RED_IDX = 3
 BANDAS_LEITURA = [BANDAS_BLUE_IDX, BANDAS_GREEN_IDX, BANDAS_RED_IDX]
 
+# Profundidade padrão das filas do pipeline em lote (itens aguardando entre estágios)
+PIPELINE_PROFUNDIDADE_PADRAO = 2
+STATS_COLUNAS = ["mean", "median", "std", "min", "max", "p25", "p75"]
+
+# =========================
+# DESEMPENHO GDAL/RASTERIO
+# =========================
+GDAL_CACHE_MB_PADRAO = 512          # GDAL_CACHEMAX (cache de blocos, em MB)
+GDAL_THREADS_PADRAO = "ALL_CPUS"    # GDAL_NUM_THREADS (descompressão DEFLATE/LZW em paralelo)
+GDAL_OVERVIEWS_PADRAO = "auto"      # "auto": leituras reduzidas usam overviews; "none": sempre resolução total
+POLITICAS_OVERVIEW = ("auto", "none")
+CONTEXTO_MAX_LADO = 600             # Lado máximo (px) da imagem do mapa de contexto
+CONTEXTO_PAINEL_PX = 3000           # Lado aproximado (px) do painel de contexto na figura a 300 dpi
+GEOMETRIAS_CACHE_MAX = 8            # Contextos preparados (arquivo, CRS) mantidos em memória
+
+# Motor do CLAHE usado em normalize_visual: "skimage" (equalize_adapthist, padrão) ou "inteiro"
+# (clahe_uint8, opcional: mais rápido, reproduz o skimage passo a passo)
+MOTORES_CLAHE = ("skimage", "inteiro")
+CLAHE_MOTOR_PADRAO = "skimage"
+CLAHE_THREADS = min(8, os.cpu_count() or 1)
+CLAHE_MIN_PIXELS_THREADS = 512 * 512  # Abaixo disso o custo das threads não compensa
+CLAHE_NIVEIS = 2 ** 14                 # Escala interna do equalize_adapthist (NR_OF_GRAY)
+CLAHE_FAIXA = 1 + CLAHE_NIVEIS // 256  # Níveis por faixa do histograma: 253 faixas usadas de 256
+
+# Mosaico virtual: o raster pode ser uma pasta de tiles ou uma lista de arquivos separados por ";"
+MOSAICO_SEPARADOR = ";"
+MOSAICO_EXTENSOES = (".tif", ".tiff")
+MOSAICO_MAX_ABERTOS = 16            # Tiles mantidos abertos simultaneamente (LRU)
+
+# Catálogo de parcelas por pasta (bounds/CRS/feições/mtime de cada shapefile)
+CATALOGO_ARQUIVO = "catalogo_parcelas.json"
+CATALOGO_VERSAO = 2
+# Arquivos de um shapefile considerados na assinatura (mtime/tamanho) e na checagem de cópia em andamento
+SHAPEFILE_COMPONENTES = (".shp", ".shx", ".dbf", ".prj")
+SHAPEFILE_OBRIGATORIOS = (".shp", ".shx", ".dbf")
+
+# Modo vigia (serviço contínuo)
+VIGIA_INTERVALO_S = 10       # Intervalo entre varreduras das pastas
+VIGIA_ESTABILIZACAO_S = 5    # Arquivos alterados há menos tempo que isso podem estar sendo copiados
+VIGIA_RETENTATIVA_S = 60     # Itens com erro são tentados de novo após esse tempo (ou se os arquivos mudarem)
+VIGIA_RASTERS_ABERTOS = 4    # Rasters mantidos abertos por worker (LRU; os excedentes são fechados)
+VIGIA_CONTEXTOS_MAX = 2      # Contextos preparados (fundo 300 dpi + RGB + gdf) mantidos por worker
+VIGIA_ESTADO_ARQUIVO = "estado_vigia.json"
+VIGIA_STATUS_ARQUIVO = "status_vigia.json"
+VIGIA_RELATORIO_ARQUIVO = "relatorio_vigia.csv"
+
+# Serviço HTTP local
+SERVICO_HOST = "127.0.0.1"
+SERVICO_PORTA = 8765
+SERVICO_FILA_POR_WORKER = 4  # Requisições admitidas por worker antes de responder 503
+SERVICO_RASTERS_ABERTOS = 8  # Pool de datasets abertos por worker (LRU): caminhos vêm dos clientes
+SERVICO_CONTEXTOS_MAX = 2    # Contextos preparados mantidos por worker (LRU)
+SERVICO_BUCKETS_S = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+# Armazém de pixels para recalibração (R/G recortados + máscara, em np.memmap)
+ARMAZEM_PIXELS_DIR = "armazem_pixels"
+ARMAZEM_VERSAO = 1
+
+# Cache persistente de máscaras das parcelas (janela + máscara empacotada com np.packbits).
+# Fica na pasta de cache do usuário (não depende da pasta de trabalho) e é podado por LRU.
+MASCARAS_CACHE_DIR = os.path.join(
+    os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "analise_agricola", "mascaras")
+MASCARAS_CACHE_MAX_MB = 512
+MASCARAS_CACHE_PODA = 0.8  # Ao passar do limite, remove as menos usadas até esta fração dele
+
+# =========================
+# VISUALIZADOR DE RESULTADOS
+# =========================
+VIEWER_TILE = 256          # Lado (px) dos tiles da pirâmide
+VIEWER_CACHE_PIXELS = 16 * 1024 * 1024  # Orçamento do cache de tiles (PhotoImage ~4 bytes/px => ~64 MB)
+VIEWER_PASSOS_OITAVA = 4   # Zoom em passos discretos de 2^(1/4): tiles redimensionados são reaproveitados
+VIEWER_ZOOM_MAX = 4.0      # Zoom máximo (pixels de tela por pixel da imagem)
+
+# Prévia rápida do modo manual, exibida antes da figura completa
+PREVIA_MAX_LADO = 256      # Lado maior (px) da parcela/contexto lidos decimados
+PREVIA_DPI = 60
+PREVIA_INTERVALO_MS = 100  # Intervalo de consulta dos resultados da thread de processamento
+
 # =========================
 # FUNÇÕES UTILS
 # =========================
@@ -46,18 +151,285 @@ def extract_parcela_number(filename):
     m = re.search(r"Parcela\s*(\d+)\.shp", filename, re.IGNORECASE)
     return int(m.group(1)) if m else None
 
-def normalize_visual(band, lower_perc=2, upper_perc=98, apply_clahe=True, clahe_clip=0.02):
-    band_float = band.astype(np.float32)
-    valid = band_float[~np.isnan(band_float)]
-    if valid.size < 10: return np.zeros_like(band_float, dtype=np.uint8)
+def componentes_shapefile(caminho_shp):
+    """Arquivos existentes do shapefile (.shp/.shx/.dbf/.prj), aceitando extensões em maiúsculas."""
+    base = os.path.splitext(caminho_shp)[0]
+    encontrados = {}
+    for ext in SHAPEFILE_COMPONENTES:
+        for candidato in (base + ext, base + ext.upper()):
+            if os.path.exists(candidato):
+                encontrados[ext] = candidato
+                break
+    return encontrados
+
+def assinatura_shapefile(caminho_shp):
+    # (mtime mais recente, tamanho total) de todos os componentes: muda se qualquer um mudar ou aparecer
+    stats = [os.stat(c) for c in componentes_shapefile(caminho_shp).values()]
+    return max(st.st_mtime for st in stats), sum(st.st_size for st in stats)
+
+class CatalogoParcelas:
+    """Catálogo persistente (catalogo_parcelas.json) dos shapefiles de uma pasta.
+
+    Guarda bounds, CRS, número de feições, mtime/tamanho e o número da parcela de cada
+    arquivo; só os arquivos novos ou alterados são relidos a cada atualização. mtime/tamanho
+    cobrem também .shx/.dbf/.prj (assinatura_shapefile).
+    """
+    def __init__(self, pasta):
+        self.pasta = pasta
+        self.caminho = os.path.join(pasta, CATALOGO_ARQUIVO)
+        self.entradas = {}
+        if os.path.exists(self.caminho):
+            try:
+                with open(self.caminho, 'r') as f:
+                    dados = json.load(f)
+                if dados.get("versao") == CATALOGO_VERSAO:
+                    self.entradas = dados.get("parcelas", {})
+            except Exception as e:
+                print(f"Catálogo inválido, recriando ({self.caminho}): {e}")
+
+    def atualizar(self):
+        """Sincroniza com a pasta e retorna os nomes dos .shp na ordem de processamento."""
+        atuais = {}
+        alterado = False
+        for entrada in os.scandir(self.pasta):
+            if not entrada.name.lower().endswith(".shp"): continue
+            mtime, tamanho = assinatura_shapefile(entrada.path)
+            antiga = self.entradas.get(entrada.name)
+            if antiga and antiga["mtime"] == mtime and antiga["tamanho"] == tamanho:
+                atuais[entrada.name] = antiga
+                continue
+            atuais[entrada.name] = self._ler_metadados(entrada.path, entrada.name, mtime, tamanho)
+            alterado = True
+
+        if alterado or set(atuais) != set(self.entradas):
+            self.entradas = atuais
+            self.salvar()
+        return sorted(self.entradas, key=lambda x: (self.entradas[x]["numero"] if self.entradas[x]["numero"] is not None else 9999, x))
+
+    def _ler_metadados(self, caminho, nome, mtime, tamanho):
+        meta = {"mtime": mtime, "tamanho": tamanho, "numero": extract_parcela_number(nome),
+                "bounds": None, "crs": None, "feicoes": 0}
+        try:
+            with fiona.open(caminho) as src:
+                meta["feicoes"] = len(src)
+                meta["crs"] = src.crs_wkt or None
+                if meta["feicoes"] > 0:
+                    meta["bounds"] = list(src.bounds)
+        except Exception as e:
+            print(f"Erro lendo metadados de {nome}: {e}")
+        return meta
 
-    vmin = np.percentile(valid, lower_perc)
-    vmax = np.percentile(valid, upper_perc)
+    def salvar(self):
+        try:
+            tmp = self.caminho + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump({"versao": CATALOGO_VERSAO, "parcelas": self.entradas}, f, indent=1)
+            os.replace(tmp, self.caminho)
+        except Exception as e:
+            print(f"Erro ao salvar catálogo: {e}")
+
+    def filtrar_por_raster(self, nomes, raster_crs, raster_bounds):
+        """Separa (dentro, fora) comparando os bounds das parcelas com a área do raster (STRtree).
+
+        Parcelas sem CRS ou sem bounds conhecidos são mantidas: o erro, se houver, aparece no processamento.
+        """
+        candidatos, caixas, dentro = [], [], set()
+        for nome in nomes:
+            meta = self.entradas[nome]
+            if not meta["bounds"] or not meta["crs"]:
+                dentro.add(nome)
+                continue
+            try:
+                b = transform_bounds(CRS.from_wkt(meta["crs"]), raster_crs, *meta["bounds"])
+            except Exception:
+                dentro.add(nome)
+                continue
+            candidatos.append(nome)
+            caixas.append(box(*b))
+
+        if caixas:
+            arvore = STRtree(caixas)
+            for i in arvore.query(box(*raster_bounds), predicate="intersects"):
+                dentro.add(candidatos[int(i)])
+        fora = [n for n in nomes if n not in dentro]
+        return [n for n in nomes if n in dentro], fora
+
+def selecionar_parcelas(folder, raster_path, opcoes=None):
+    """Lista as parcelas da pasta (via catálogo) e descarta, sem ler pixels, as que estão fora do raster.
+
+    Retorna (parcelas a processar, parcelas fora da imagem).
+    """
+    catalogo = CatalogoParcelas(folder)
+    nomes = catalogo.atualizar()
+    if not nomes: return [], []
+    with ambiente_gdal(opcoes), abrir_raster(raster_path, opcoes) as ds:
+        if ds.crs is None: return nomes, []
+        return catalogo.filtrar_por_raster(nomes, ds.crs, ds.bounds)
+
+def carregar_settings():
+    default_settings = {
+        "fullscreen": False,
+        "remember_last_dir": True,
+        "default_dir": os.path.expanduser("~"),
+        "pipeline_queue_depth": PIPELINE_PROFUNDIDADE_PADRAO,
+        "gdal_cache_mb": GDAL_CACHE_MB_PADRAO,
+        "gdal_num_threads": GDAL_THREADS_PADRAO,
+        "gdal_overview_policy": GDAL_OVERVIEWS_PADRAO,
+        "clahe_engine": CLAHE_MOTOR_PADRAO
+    }
+    if os.path.exists(CONFIG_FILE):
+        try:
+            with open(CONFIG_FILE, 'r') as f:
+                return json.load(f)
+        except:
+            return default_settings
+    return default_settings
+
+_MOTOR_CLAHE = CLAHE_MOTOR_PADRAO
+
+def definir_motor_clahe(motor):
+    # Motor global do processo (GUI/CLI a partir das configurações; workers pelo initializer)
+    global _MOTOR_CLAHE
+    _MOTOR_CLAHE = motor if motor in MOTORES_CLAHE else CLAHE_MOTOR_PADRAO
+
+def motor_clahe():
+    return _MOTOR_CLAHE
+
+def _redistribuir_resto(hist, limite, resto):
+    # Mesma ordem do clip_histogram do skimage: passos sobre o histograma inteiro, a partir de cada índice
+    while resto > 0:
+        anterior = resto
+        for indice in range(hist.size):
+            abaixo = hist < limite
+            passo = max(1, np.count_nonzero(abaixo) // resto)
+            sel = abaixo[indice::passo]
+            hist[indice::passo][sel] += 1
+            resto -= np.count_nonzero(sel)
+            if resto <= 0: break
+        if anterior == resto: break
+
+def faixas_clahe(band_norm):
+    """Quantiza uma banda em [0, 1] nas faixas do equalize_adapthist (0-252), para o clahe_uint8."""
+    valores = img_as_uint(band_norm)
+    vmin, vmax = int(valores.min()), int(valores.max())
+    # Mesma reescala do skimage, aplicada numa tabela dos 65536 valores uint16
+    niveis = np.round(exposure.rescale_intensity(np.arange(65536, dtype=np.uint16), in_range=(vmin, vmax),
+                                                 out_range=(0, CLAHE_NIVEIS - 1)))
+    tabela = (niveis.astype(np.uint16) // CLAHE_FAIXA).astype(np.uint8)
+    return tabela[valores]
+
+def clahe_uint8(img, clip_limit=0.02, n_threads=CLAHE_THREADS):
+    """CLAHE direto em uint8, com histogramas inteiros por região.
+
+    Reproduz o equalize_adapthist passo a passo: mesmas regiões (lado/8, completadas por
+    reflexão no fim), mesmo limite de corte (clip_limit * pixels da região), mesma
+    redistribuição do excesso (incremento igual nos 256 níveis e o resto na ordem do
+    clip_histogram), LUTs truncadas na escala de 0 a 16383, interpolação bilinear entre as 4
+    regiões vizinhas e reescala final para 0-255. Histogramas (por linha de regiões) e
+    interpolação (por faixa de linhas) rodam em threads.
+
+    Para ficar igual ao skimage, `img` deve vir de faixas_clahe (as 253 faixas que o skimage
+    usa); com outros uint8 o algoritmo é o mesmo, mas em 256 níveis.
+
+    Comparado ao caminho do skimage em normalize_visual (skimage 0.26, clip 0,02), o resultado
+    foi idêntico pixel a pixel em: camera, astronaut (R), coffee (R), chelsea (B), rocket (G),
+    page, text, moon, coins, brick, grass, gravel, horse e checkerboard do skimage; nas bandas de
+    uma ortofoto RGB uint8, com e sem máscara de parcela; em ruído aleatório de 3x3 a 1001x777;
+    e em imagens sintéticas bimodais e de baixo contraste. As diferenças da versão anterior (até 21 níveis
+    em page/text) vinham das 256 faixas no lugar das 253 do skimage e da ordem do corte.
+    """
+    h, w = img.shape
+    kh, kw = max(h // 8, 1), max(w // 8, 1)
+    nh, nw = -(-h // kh), -(-w // kw)
+    area = kh * kw
+    limite = int(max(clip_limit * area, 1)) if clip_limit > 0 else area
+    completa = np.pad(img, ((0, nh * kh - h), (0, nw * kw - w)), mode='reflect')
+    n_threads = n_threads if h * w >= CLAHE_MIN_PIXELS_THREADS else 1
+
+    deslocamento = (np.arange(nw, dtype=np.int32) * 256)[:, None]
+    def histogramas(i):
+        regioes = completa[i * kh:(i + 1) * kh].reshape(kh, nw, kw).transpose(1, 0, 2).reshape(nw, area)
+        return np.bincount((regioes + deslocamento).ravel(), minlength=nw * 256).reshape(nw, 256)
+
+    with ThreadPoolExecutor(n_threads) as ex:
+        hist = np.concatenate(list(ex.map(histogramas, range(nh)))).astype(np.int64)
+
+    # Corte + redistribuição: incremento igual para todos os níveis, o resto na ordem do skimage
+    # (como no skimage, níveis que o incremento deixa perto do limite também sobem até ele)
+    excesso = np.maximum(hist - limite, 0).sum(axis=1)
+    cortado = np.minimum(hist, limite)
+    incremento = (excesso // 256)[:, None]
+    superior = limite - incremento
+    hist = np.where(cortado < superior, cortado + incremento, cortado)
+    hist[(hist >= superior) & (hist < limite)] = limite
+    resto = excesso - (hist - cortado).sum(axis=1)
+    for t in np.flatnonzero(resto > 0):
+        _redistribuir_resto(hist[t], limite, int(resto[t]))
+
+    # LUT como no map_histogram do skimage: escala de 0 a CLAHE_NIVEIS-1, truncada para inteiro
+    tabela = np.floor(np.minimum(np.cumsum(hist, axis=1) * ((CLAHE_NIVEIS - 1) / area), CLAHE_NIVEIS - 1))
+
+    # Regiões vizinhas (antes/depois) e peso de cada linha/coluna, como nos blocos do skimage
+    def vizinhas(n, k, nt):
+        pos = np.arange(n) + k // 2
+        b = pos // k
+        return (np.clip(b - 1, 0, nt - 1), np.clip(b, 0, nt - 1), (pos % k) / k)
+    ty0, ty1, fy = vizinhas(h, kh, nh)
+    tx0, tx1, fx = vizinhas(w, kw, nw)
+    base0 = (tx0 * 256).astype(np.int32)
+    base1 = (tx1 * 256).astype(np.int32)
+
+    # Faixas de linhas com o mesmo par de regiões verticais. Cada pixel soma as 4 LUTs vizinhas
+    # com os pesos e a ordem do skimage (produto em float64, soma em float32): o resultado é
+    # truncado para inteiro em seguida, então a ordem das operações decide níveis inteiros.
+    tabela = tabela.reshape(nh, nw * 256)
+    inicios = [0] + list(range(kh - kh // 2, h, kh))
+    saida = np.zeros((h, w), dtype=np.float32)
+    def interpolar(j):
+        y0, y1 = inicios[j], (inicios[j + 1] if j + 1 < len(inicios) else h)
+        l0, l1 = tabela[ty0[y0]], tabela[ty1[y0]]
+        cy = fy[y0:y1, None]
+        v = img[y0:y1].astype(np.int32)
+        esq, dir_ = v + base0, v + base1
+        acc = saida[y0:y1]
+        peso = np.empty(v.shape)
+        termo = np.empty(v.shape)
+        for lut, idx, wx, wy in ((l0, esq, 1 - fx, 1 - cy), (l0, dir_, fx, 1 - cy),
+                                 (l1, esq, 1 - fx, cy), (l1, dir_, fx, cy)):
+            np.multiply(wx, wy, out=peso)
+            np.take(lut, idx, out=termo)
+            termo *= peso
+            # Cada termo vira float32 antes da soma, como no skimage
+            np.add(acc, termo, out=acc, dtype=np.float32, casting="same_kind")
+
+    with ThreadPoolExecutor(n_threads) as ex:
+        list(ex.map(interpolar, range(len(inicios))))
+
+    np.floor(saida, out=saida)  # O skimage converte a interpolação para inteiro antes de reescalar
+    vmin, vmax = float(saida.min()), float(saida.max())
+    # Saída constante: o rescale_intensity do skimage a leva ao máximo
+    if vmax <= vmin: return np.full((h, w), 255, dtype=np.uint8)
+    saida -= vmin
+    saida /= np.float32(vmax - vmin)
+    saida *= np.float32(255)
+    return saida.astype(np.uint8)
+
+def normalize_visual(band, lower_perc=2, upper_perc=98, apply_clahe=True, clahe_clip=0.02, valido=None, motor=None):
+    # `valido` é a máscara de pixels válidos; sem ela, NaN marca os inválidos (bandas float)
+    if valido is None:
+        valido = ~np.isnan(band) if band.dtype.kind == 'f' else np.ones(band.shape, dtype=bool)
+    valid = band[valido]
+    if valid.size < 10: return np.zeros(band.shape, dtype=np.uint8)
+
+    vmin, vmax = (float(v) for v in np.percentile(valid, [lower_perc, upper_perc]))
     if vmax <= vmin: vmax = vmin + 1e-9
 
-    band_norm = (np.clip(band_float, vmin, vmax) - vmin) / (vmax - vmin + 1e-9)
+    band_norm = (np.clip(band.astype(np.float32), vmin, vmax) - vmin) / (vmax - vmin + 1e-9)
     band_norm = np.clip(band_norm, 0.0, 1.0)
-    band_norm[np.isnan(band_norm)] = 0.0
+    band_norm[~valido] = 0.0
+
+    if apply_clahe and (motor or _MOTOR_CLAHE) == "inteiro":
+        return clahe_uint8(faixas_clahe(band_norm), clahe_clip)
 
     if apply_clahe:
         try:
@@ -67,56 +439,539 @@ def normalize_visual(band, lower_perc=2, upper_perc=98, apply_clahe=True, clahe_
     band_norm[np.isnan(band_norm)] = 0.0
     return (band_norm * 255).astype(np.uint8)
 
-def get_recorte_data(dataset, geometry_list):
+def opcoes_gdal(settings):
+    threads = str(settings.get("gdal_num_threads", GDAL_THREADS_PADRAO)).strip().upper() or GDAL_THREADS_PADRAO
+    politica = settings.get("gdal_overview_policy", GDAL_OVERVIEWS_PADRAO)
+    return {
+        "cache_mb": max(16, int(settings.get("gdal_cache_mb", GDAL_CACHE_MB_PADRAO))),
+        "num_threads": threads,
+        "overview_policy": politica if politica in POLITICAS_OVERVIEW else GDAL_OVERVIEWS_PADRAO,
+    }
+
+def ambiente_gdal(opcoes=None):
+    # rasterio.Env é local à thread: cada thread que lê raster precisa entrar no seu próprio
+    opcoes = opcoes or opcoes_gdal({})
+    return rasterio.Env(GDAL_CACHEMAX=opcoes["cache_mb"], GDAL_NUM_THREADS=opcoes["num_threads"])
+
+def abrir_raster(raster_path, opcoes=None):
+    # Pasta de tiles ou lista "a.tif;b.tif" vira um MosaicoVirtual; caso contrário, um dataset rasterio
+    opcoes = opcoes or opcoes_gdal({})
+    kwargs = {}
+    if opcoes["overview_policy"] == "none":
+        kwargs["OVERVIEW_LEVEL"] = "NONE"
+    tiles = tiles_mosaico(raster_path)
+    if tiles is not None:
+        return MosaicoVirtual(tiles, kwargs)
+    return rasterio.open(raster_path, **kwargs)
+
+def tiles_mosaico(raster_path):
+    """Lista de tiles se `raster_path` descreve um mosaico (pasta ou lista com ";"), senão None."""
+    # Um arquivo existente é sempre um raster único, mesmo que o nome contenha ";" (ex.: "voo;13.tif")
+    if os.path.isfile(raster_path): return None
+    if os.path.isdir(raster_path):
+        tiles = sorted(os.path.join(raster_path, f) for f in os.listdir(raster_path)
+                       if f.lower().endswith(MOSAICO_EXTENSOES))
+        if not tiles: raise FileNotFoundError(f"Nenhum TIFF encontrado em {raster_path}")
+        return tiles
+    if MOSAICO_SEPARADOR in raster_path:
+        return [t.strip() for t in raster_path.split(MOSAICO_SEPARADOR) if t.strip()]
+    return None
+
+def arquivos_raster(raster_path):
+    # Arquivos que compõem o raster: os tiles de um mosaico ou o próprio arquivo
+    return tiles_mosaico(raster_path) or [raster_path]
+
+def rasters_inexistentes(raster_path):
+    # Entradas ausentes de um raster (arquivo único, pasta de tiles ou lista com ";")
     try:
-        recorte, out_transform = rasterio.mask.mask(
-            dataset, geometry_list, crop=True, filled=True, nodata=0, indexes=BANDAS_LEITURA
-        )
-    except ValueError as e:
-        if "Input shapes do not overlap raster" in str(e): return None, None, None, None
-        raise
+        return [t for t in arquivos_raster(raster_path) if not os.path.isfile(t)]
+    except FileNotFoundError:
+        return [raster_path]
+
+def mtime_raster(raster_path):
+    # Para mosaicos, o tile modificado mais recentemente (e a quantidade de tiles)
+    tiles = tiles_mosaico(raster_path)
+    if tiles is None: return os.path.getmtime(raster_path)
+    return (max(os.path.getmtime(t) for t in tiles), len(tiles))
+
+class MosaicoVirtual:
+    """Conjunto de tiles na mesma grade, lido como se fosse um único raster.
+
+    Só o cabeçalho de cada tile é lido na abertura; os limites dos tiles ficam numa STRtree e
+    cada leitura (janela na grade do mosaico) busca apenas os tiles que a intersectam, lê a
+    parte de cada um e monta o resultado em memória. Nenhum mosaico é gravado em disco.
+    Implementa o subconjunto da API de dataset usado pelo app (read, read_masks, window_transform...).
+    """
+    def __init__(self, tiles, kwargs_abertura=None):
+        self.kwargs_abertura = kwargs_abertura or {}
+        self.tiles = []
+        for caminho in tiles:
+            with rasterio.open(caminho, **self.kwargs_abertura) as ds:
+                self.tiles.append({"caminho": caminho, "transform": ds.transform, "bounds": ds.bounds,
+                                   "width": ds.width, "height": ds.height, "crs": ds.crs, "count": ds.count,
+                                   "dtype": ds.dtypes[0], "nodata": ds.nodata, "flags": ds.mask_flag_enums})
+        if not self.tiles: raise ValueError("Mosaico sem tiles.")
+
+        ref = self.tiles[0]
+        res_x, res_y = ref["transform"].a, ref["transform"].e
+        for t in self.tiles[1:]:
+            if t["crs"] != ref["crs"]:
+                raise ValueError(f"Tile com CRS diferente: {t['caminho']}")
+            if (t["count"], t["dtype"], t["nodata"]) != (ref["count"], ref["dtype"], ref["nodata"]):
+                raise ValueError(f"Tile com bandas/tipo/nodata diferentes: {t['caminho']}")
+            if not np.allclose((t["transform"].a, t["transform"].e, t["transform"].b, t["transform"].d),
+                               (res_x, res_y, 0, 0)):
+                raise ValueError(f"Tile com resolução diferente (reamostre antes de usar): {t['caminho']}")
+
+        left = min(t["bounds"].left for t in self.tiles)
+        top = max(t["bounds"].top for t in self.tiles)
+        right = max(t["bounds"].right for t in self.tiles)
+        bottom = min(t["bounds"].bottom for t in self.tiles)
+        self.crs = ref["crs"]
+        self.count = ref["count"]
+        self.dtypes = (ref["dtype"],) * ref["count"]
+        self.nodata = ref["nodata"]
+        self.transform = Affine(res_x, 0, left, 0, res_y, top)
+        self.width = int(round((right - left) / res_x))
+        self.height = int(round((bottom - top) / res_y))
+        self.bounds = BoundingBox(left, bottom, right, top)
+
+        # Posição (coluna, linha) de cada tile na grade do mosaico; exige tiles alinhados à grade
+        for t in self.tiles:
+            col = (t["bounds"].left - left) / res_x
+            row = (t["bounds"].top - top) / res_y
+            if abs(col - round(col)) > 1e-3 or abs(row - round(row)) > 1e-3:
+                raise ValueError(f"Tile fora da grade do mosaico: {t['caminho']}")
+            t["col"], t["row"] = int(round(col)), int(round(row))
+
+        if self.nodata is not None:
+            flags = [MaskFlags.nodata]
+        elif any(MaskFlags.per_dataset in f or MaskFlags.alpha in f for t in self.tiles for f in t["flags"]):
+            flags = [MaskFlags.per_dataset]
+        else:
+            # Fora dos tiles o mosaico é preenchido com 0, que o app já trata como "sem dado"
+            flags = [MaskFlags.all_valid]
+        self.mask_flag_enums = tuple(flags for _ in range(self.count))
+
+        self.indice = STRtree([box(*t["bounds"]) for t in self.tiles])
+        self._abertos = OrderedDict()
+
+    def _dataset(self, i):
+        ds = self._abertos.get(i)
+        if ds is not None:
+            self._abertos.move_to_end(i)
+            return ds
+        ds = rasterio.open(self.tiles[i]["caminho"], **self.kwargs_abertura)
+        self._abertos[i] = ds
+        while len(self._abertos) > MOSAICO_MAX_ABERTOS:
+            self._abertos.popitem(last=False)[1].close()
+        return ds
+
+    def window_transform(self, janela):
+        return transform_janela(janela, self.transform)
+
+    def _montar(self, ler_tile, n_bandas, dtype, preenchimento, window, out_shape):
+        if window is None: window = Window(0, 0, self.width, self.height)
+        c0, r0 = int(round(window.col_off)), int(round(window.row_off))
+        w, h = int(round(window.width)), int(round(window.height))
+        oh, ow = (h, w) if out_shape is None else out_shape[-2:]
+        sy, sx = oh / h, ow / w
+        saida = np.full((n_bandas, oh, ow), preenchimento, dtype=dtype)
+
+        alvo = box(*limites_janela(Window(c0, r0, w, h), self.transform))
+        for i in sorted(self.indice.query(alvo, predicate="intersects")):
+            t = self.tiles[i]
+            # Interseção da janela com o tile, em pixels da grade do mosaico
+            ic0, ic1 = max(c0, t["col"]), min(c0 + w, t["col"] + t["width"])
+            ir0, ir1 = max(r0, t["row"]), min(r0 + h, t["row"] + t["height"])
+            if ic1 <= ic0 or ir1 <= ir0: continue
+            # Destino no array de saída (escalado quando há out_shape)
+            d_c0, d_c1 = int(round((ic0 - c0) * sx)), int(round((ic1 - c0) * sx))
+            d_r0, d_r1 = int(round((ir0 - r0) * sy)), int(round((ir1 - r0) * sy))
+            if d_c1 <= d_c0 or d_r1 <= d_r0: continue
+            janela_tile = Window(ic0 - t["col"], ir0 - t["row"], ic1 - ic0, ir1 - ir0)
+            saida[:, d_r0:d_r1, d_c0:d_c1] = ler_tile(self._dataset(i), janela_tile, (n_bandas, d_r1 - d_r0, d_c1 - d_c0))
+        return saida
+
+    def read(self, indexes=None, window=None, out_shape=None, resampling=Resampling.nearest):
+        unico = isinstance(indexes, int)
+        bandas = [indexes] if unico else list(indexes or range(1, self.count + 1))
+        preenchimento = self.nodata if self.nodata is not None else 0
+        saida = self._montar(
+            lambda ds, janela, forma: ds.read(bandas, window=janela, out_shape=forma, resampling=resampling),
+            len(bandas), self.dtypes[0], preenchimento, window, out_shape)
+        return saida[0] if unico else saida
+
+    def read_masks(self, indexes=None, window=None, out_shape=None, resampling=Resampling.nearest):
+        unico = isinstance(indexes, int)
+        bandas = [indexes] if unico else list(indexes or range(1, self.count + 1))
+        saida = self._montar(
+            lambda ds, janela, forma: ds.read_masks(bandas, window=janela, out_shape=forma, resampling=resampling),
+            len(bandas), np.uint8, 0, window, out_shape)
+        return saida[0] if unico else saida
+
+    def close(self):
+        for ds in self._abertos.values():
+            ds.close()
+        self._abertos.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def formatar_opcoes_gdal(opcoes):
+    return f"GDAL: cache={opcoes['cache_mb']}MB, threads={opcoes['num_threads']}, overviews={opcoes['overview_policy']}"
+
+def janela_geometria(transform, largura, altura, bounds):
+    # Janela (em pixels) que cobre os bounds, recortada aos limites do raster; None se não sobrepõe
+    inv = ~transform
+    xmin, ymin, xmax, ymax = bounds
+    cols, rows = zip(*[inv * (x, y) for x, y in ((xmin, ymin), (xmin, ymax), (xmax, ymin), (xmax, ymax))])
+    c0 = max(0, math.floor(min(cols))); c1 = min(largura, math.ceil(max(cols)))
+    r0 = max(0, math.floor(min(rows))); r1 = min(altura, math.ceil(max(rows)))
+    if c1 <= c0 or r1 <= r0: return None
+    return Window(c0, r0, c1 - c0, r1 - r0)
+
+def mascara_dados(dataset, recorte, janela, out_shape=None):
+    """Pixels com dado válido (True) segundo o nodata do dataset ou sua máscara interna.
+
+    Um pixel é inválido se qualquer banda lida for nodata. Sem nodata nem banda de
+    máscara/alfa, mantém a convenção antiga do app: valor 0 = sem dado.
+    """
+    if dataset.nodata is not None:
+        return np.all(recorte != dataset.nodata, axis=0)
+    flags = [dataset.mask_flag_enums[i - 1] for i in BANDAS_LEITURA]
+    if any(MaskFlags.per_dataset in f or MaskFlags.alpha in f for f in flags):
+        kwargs = {"window": janela}
+        if out_shape is not None: kwargs["out_shape"] = out_shape
+        return dataset.read_masks(BANDAS_LEITURA[0], **kwargs) > 0
+    return np.all(recorte != 0, axis=0)
+
+def get_recorte_reduzido(dataset, geometry_list, max_lado):
+    """Recorte decimado (lado maior <= max_lado) para visualização.
+
+    A leitura com out_shape deixa o GDAL usar os overviews internos do TIFF (quando a
+    política permite), em vez de ler e mascarar a área inteira em resolução total.
+    """
+    geoms = [shape(g) if isinstance(g, dict) else g for g in geometry_list]
+    janela = janela_geometria(dataset.transform, dataset.width, dataset.height, unary_union(geoms).bounds)
+    if janela is None: return None, None, None, None, None
+
+    escala = max(janela.height, janela.width) / max_lado
+    if escala <= 1:
+        return get_recorte_data(dataset, geometry_list)
+    out_h = max(1, int(math.ceil(janela.height / escala)))
+    out_w = max(1, int(math.ceil(janela.width / escala)))
+    recorte = dataset.read(BANDAS_LEITURA, window=janela, out_shape=(len(BANDAS_LEITURA), out_h, out_w), resampling=Resampling.average)
+    out_transform = dataset.window_transform(janela) * Affine.scale(janela.width / out_w, janela.height / out_h)
+    dentro = geometry_mask(geoms, out_shape=(out_h, out_w), transform=out_transform, invert=True)
+    valido = dentro & mascara_dados(dataset, recorte, janela, out_shape=(out_h, out_w))
+
+    out_bounds = array_bounds(out_h, out_w, out_transform)
+    extent = (out_bounds[0], out_bounds[2], out_bounds[1], out_bounds[3])
+
+    return recorte[2], recorte[1], recorte[0], valido, extent
+
+class CacheMascaras:
+    """Cache em disco da rasterização das geometrias na grade do raster.
+
+    A chave é (hash da geometria, CRS, transform, dimensões do raster); o valor é a janela
+    de leitura e a máscara da geometria dentro dela, empacotada em bits. Com a máscara em
+    cache, um recorte vira "lê a janela + aplica a máscara", sem rasterizar o polígono.
+    Geometrias fora do raster também ficam registradas (janela vazia). O uso renova o mtime
+    do arquivo, e a pasta é podada (menos usados primeiro) ao passar de `max_mb`.
+    """
+    def __init__(self, pasta=MASCARAS_CACHE_DIR, max_mb=MASCARAS_CACHE_MAX_MB):
+        self.pasta = pasta
+        self.max_bytes = max_mb * 1024 * 1024
+        self.acertos = 0
+        self.falhas = 0
+        self._tamanho = None  # Estimativa do tamanho da pasta; medida na primeira gravação
+        self._lock = threading.Lock()
+
+    def _chave(self, geoms, dataset):
+        h = hashlib.sha1()
+        for g in geoms:
+            h.update(g.wkb)
+        h.update(str(dataset.crs).encode())
+        h.update(repr(tuple(dataset.transform)[:6]).encode())
+        h.update(f"{dataset.width}x{dataset.height}".encode())
+        return h.hexdigest()
+
+    def obter(self, dataset, geometry_list):
+        """Retorna (janela, máscara booleana True dentro da geometria) ou None se não há sobreposição."""
+        geoms = [shape(g) if isinstance(g, dict) else g for g in geometry_list]
+        caminho = os.path.join(self.pasta, self._chave(geoms, dataset) + ".npz")
+
+        if os.path.exists(caminho):
+            try:
+                with np.load(caminho) as dados:
+                    col_off, row_off, w, h = (int(v) for v in dados["janela"])
+                    bits = dados["bits"]
+                with self._lock: self.acertos += 1
+                try:
+                    os.utime(caminho)  # Marca como usado recentemente para a poda
+                except OSError:
+                    pass
+                if w == 0 or h == 0: return None
+                dentro = np.unpackbits(bits, count=h * w).reshape(h, w).astype(bool)
+                return Window(col_off, row_off, w, h), dentro
+            except Exception as e:
+                print(f"Cache de máscara inválido ({caminho}): {e}")
+
+        with self._lock: self.falhas += 1
+        janela = janela_geometria(dataset.transform, dataset.width, dataset.height, unary_union(geoms).bounds)
+        dentro = None
+        if janela is not None:
+            dentro = geometry_mask(geoms, out_shape=(janela.height, janela.width),
+                                   transform=dataset.window_transform(janela), invert=True)
+            if not dentro.any(): janela = None
+
+        self._salvar(caminho, janela, dentro)
+        if janela is None: return None
+        return janela, dentro
+
+    def _salvar(self, caminho, janela, dentro):
+        try:
+            os.makedirs(self.pasta, exist_ok=True)
+            if janela is None:
+                arr_janela, bits = np.zeros(4, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+            else:
+                arr_janela = np.array([janela.col_off, janela.row_off, janela.width, janela.height], dtype=np.int64)
+                bits = np.packbits(dentro)
+            # Grava em arquivo temporário e renomeia: leitores concorrentes nunca veem arquivo parcial
+            tmp = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                np.savez(f, janela=arr_janela, bits=bits)
+            os.replace(tmp, caminho)
+            with self._lock:
+                if self._tamanho is None: self._tamanho = self._medir()[0]
+                else: self._tamanho += os.path.getsize(caminho)
+                podar = self._tamanho > self.max_bytes
+            if podar: self.podar()
+        except Exception as e:
+            print(f"Erro salvando cache de máscara: {e}")
+
+    def _medir(self):
+        total, arquivos = 0, []
+        if os.path.isdir(self.pasta):
+            for entrada in os.scandir(self.pasta):
+                if entrada.name.endswith(".npz"):
+                    st = entrada.stat()
+                    total += st.st_size
+                    arquivos.append((st.st_mtime, st.st_size, entrada.path))
+        return total, arquivos
+
+    def podar(self):
+        # Remove as máscaras usadas há mais tempo até MASCARAS_CACHE_PODA do limite
+        total, arquivos = self._medir()
+        alvo = self.max_bytes * MASCARAS_CACHE_PODA
+        if total > self.max_bytes:
+            for _, tamanho, caminho in sorted(arquivos):
+                if total <= alvo: break
+                try:
+                    os.remove(caminho)
+                    total -= tamanho
+                except OSError:
+                    pass
+        with self._lock: self._tamanho = total
+
+    def contadores(self):
+        with self._lock:
+            return self.acertos, self.falhas
+
+    def resumo(self, desde=(0, 0)):
+        acertos, falhas = self.contadores()
+        acertos -= desde[0]; falhas -= desde[1]
+        tamanho, arquivos = self._medir()
+        n_arquivos = len(arquivos)
+        total = acertos + falhas
+        return {"acertos": acertos, "falhas": falhas, "taxa_acerto": (acertos / total) if total else 0.0,
+                "arquivos": n_arquivos, "tamanho_bytes": tamanho}
+
+def formatar_resumo_mascaras(r):
+    return (f"Máscaras: {r['acertos']}/{r['acertos'] + r['falhas']} em cache ({r['taxa_acerto']*100:.0f}%), "
+            f"{r['arquivos']} arquivos, {r['tamanho_bytes']/1024:.0f} KB")
+
+CACHE_MASCARAS = CacheMascaras()
+
+# =========================
+# GEOMETRIAS DE CONTEXTO
+# =========================
+class GeometriaPreparada:
+    """Shapefile de contexto reprojetado para um CRS.
+
+    `exata` é a geometria dissolvida (unary_union), usada nas máscaras; `para_exibicao` devolve
+    as feições simplificadas para o tamanho de pixel de saída, usadas só nos contornos desenhados.
+    """
+    def __init__(self, gdf):
+        self.gdf = gdf
+        self.exata = unary_union(gdf.geometry)
+        self._exibicao = {}
+        self._lock = threading.Lock()
+
+    def para_exibicao(self, tamanho_pixel):
+        # Desvios menores que meio pixel de saída não aparecem no contorno desenhado
+        tolerancia = float(tamanho_pixel) / 2
+        with self._lock:
+            gdf = self._exibicao.get(tolerancia)
+        if gdf is None:
+            gdf = self.gdf.copy()
+            if tolerancia > 0:
+                gdf["geometry"] = self.gdf.geometry.simplify(tolerancia, preserve_topology=True)
+            with self._lock:
+                self._exibicao[tolerancia] = gdf
+        return gdf
+
+    def exibicao_para_extent(self, extent, lado_px):
+        """Feições simplificadas para desenhar `extent` (x0, x1, y0, y1) em `lado_px` pixels no lado maior."""
+        return self.para_exibicao(max(extent[1] - extent[0], extent[3] - extent[2]) / max(1, lado_px))
+
+class CacheGeometrias:
+    """Contextos preparados em memória (LRU), por (caminho, mtime, tamanho, CRS)."""
+    def __init__(self, max_itens=GEOMETRIAS_CACHE_MAX):
+        self.max_itens = max_itens
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obter(self, caminho, crs):
+        st = os.stat(caminho)
+        chave = (os.path.abspath(caminho), st.st_mtime_ns, st.st_size, CRS.from_user_input(crs).to_string())
+        with self._lock:
+            preparada = self._itens.get(chave)
+            if preparada is not None:
+                self._itens.move_to_end(chave)
+                return preparada
+        preparada = GeometriaPreparada(gpd.read_file(caminho).to_crs(crs))
+        with self._lock:
+            self._itens[chave] = preparada
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+        return preparada
+
+CACHE_GEOMETRIAS = CacheGeometrias()
+
+def get_recorte_data(dataset, geometry_list, cache=None):
+    """Recorte da geometria em resolução total.
+
+    Retorna (R, G, B, valido, extent): bandas no tipo nativo do raster (uint8/uint16) e uma
+    única máscara booleana de pixels válidos (dentro da geometria e com dado).
+    """
+    cache = cache or CACHE_MASCARAS
+    resultado = cache.obter(dataset, geometry_list)
+    if resultado is None: return None, None, None, None, None
+    janela, dentro = resultado
+
+    recorte = dataset.read(BANDAS_LEITURA, window=janela)
+    valido = dentro & mascara_dados(dataset, recorte, janela)
+    out_transform = dataset.window_transform(janela)
 
     out_bounds = array_bounds(recorte.shape[1], recorte.shape[2], out_transform)
     extent = (out_bounds[0], out_bounds[2], out_bounds[1], out_bounds[3])
 
-    B = recorte[0].astype(np.float32); B[B == 0] = np.nan
-    G = recorte[1].astype(np.float32); G[G == 0] = np.nan
-    R = recorte[2].astype(np.float32); R[R == 0] = np.nan
-
-    return R, G, B, extent
+    return recorte[2], recorte[1], recorte[0], valido, extent
 
 # =========================
 # PLOTAGEM
 # =========================
+class ProcessamentoCancelado(Exception):
+    pass
+
+def verificar_cancelamento(cancelado):
+    # `cancelado` (callable ou None) é consultado entre etapas longas do modo manual
+    if cancelado is not None and cancelado(): raise ProcessamentoCancelado()
+
+class FundoContexto:
+    """Painel 1 ("Mapa de Contexto") pré-renderizado: imagem + contorno amarelo da área total.
+
+    `imagem` é a área de dados do painel já rasterizada no DPI de saída e `extent` os limites
+    (x0, x1, y0, y1) que ela cobre; no lote cada parcela só desenha o próprio contorno por cima.
+    """
+    def __init__(self, imagem, extent):
+        self.imagem = imagem
+        self.extent = extent
+
+def renderizar_fundo_contexto(RGB_contexto, extent_contexto, shp_contexto_gdf, dpi=300):
+    if RGB_contexto is None or extent_contexto is None: return None
+    # Mesma grade e ajustes de gerar_plot_complexo, para o painel sair com praticamente o mesmo tamanho
+    fig = Figure(figsize=(20, 12), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax0 = fig.add_subplot(fig.add_gridspec(3, 6)[0, 0:4])
+    fig.subplots_adjust(left=0.09, right=0.838, top=0.95, wspace=0.15, hspace=0.25)
+    ax0.imshow(RGB_contexto, extent=extent_contexto)
+    try:
+        shp_contexto_gdf.boundary.plot(ax=ax0, color='yellow', linewidth=2)
+    except Exception:
+        pass
+    ax0.set_xlim(extent_contexto[0], extent_contexto[1])
+    ax0.set_ylim(extent_contexto[2], extent_contexto[3])
+    ax0.axis('off')
+    fig.canvas.draw()
+
+    caixa = ax0.get_window_extent()
+    pixels = np.asarray(fig.canvas.buffer_rgba())
+    altura = pixels.shape[0]
+    x0, x1 = int(round(caixa.x0)), int(round(caixa.x1))
+    y0, y1 = altura - int(round(caixa.y1)), altura - int(round(caixa.y0))
+    imagem = pixels[y0:y1, x0:x1, :3].copy()
+    xlim, ylim = ax0.get_xlim(), ax0.get_ylim()
+    return FundoContexto(imagem, (xlim[0], xlim[1], ylim[0], ylim[1]))
+
 def gerar_plot_complexo(
-    R_par, G_par, B_par, NIR_par, NDVI_par,
+    R_par, G_par, B_par, NIR_par, NDVI_par, valido_par,
     RGB_contexto, extent_contexto,
-    shp_contexto_gdf, shp_parcela_gdf
+    shp_contexto_gdf, shp_parcela_gdf,
+    compress_level=6, retornar_png=False, fundo_contexto=None,
+    dpi=300, apply_clahe=True, cancelado=None
 ):
+    # Sem retornar_png devolve uma PIL.Image RGBA sobre o buffer bruto do Agg (nenhuma codificação):
+    # o PNG é gerado uma única vez por quem grava. retornar_png=True devolve os bytes do PNG
+    # (compress_level) em vez da imagem (serviço HTTP).
+    # fundo_contexto (FundoContexto) substitui o imshow do contexto + contorno amarelo no painel 1.
+    # dpi/apply_clahe reduzidos geram a prévia rápida do modo manual; `cancelado` interrompe
+    # a figura entre os painéis e antes do savefig (ProcessamentoCancelado).
+    # A figura não passa pelo pyplot, então pode ser gerada fora da thread da interface.
     
     # Mude a grade para 3 linhas e 6 colunas
-    fig = plt.figure(figsize=(20, 12)) 
+    fig = Figure(figsize=(20, 12))
+    FigureCanvasAgg(fig)
+    grade = fig.add_gridspec(3, 6)
 
     # --- LINHA 0: Contexto e Zoom (Preenche a linha) ---
     # Contexto: 4 colunas (à esquerda)
-    ax0 = plt.subplot2grid((3, 6), (0, 0), colspan=4) 
+    ax0 = fig.add_subplot(grade[0, 0:4])
     # Zoom: 2 colunas (à direita)
-    ax1 = plt.subplot2grid((3, 6), (0, 4), colspan=2)            
+    ax1 = fig.add_subplot(grade[0, 4:6])
     
     # --- LINHA 1: R, G, B (Centralizado, 2 colunas por plot) ---
     # Começa na coluna 0, cada um com colspan=2
-    ax2 = plt.subplot2grid((3, 6), (1, 0), colspan=2) # Banda Vermelha
-    ax3 = plt.subplot2grid((3, 6), (1, 2), colspan=2) # Banda Verde
-    ax4 = plt.subplot2grid((3, 6), (1, 4), colspan=2) # Banda Azul
+    ax2 = fig.add_subplot(grade[1, 0:2]) # Banda Vermelha
+    ax3 = fig.add_subplot(grade[1, 2:4]) # Banda Verde
+    ax4 = fig.add_subplot(grade[1, 4:6]) # Banda Azul
 
     # --- LINHA 2: NIR, NDVI (Centralizado, 3 colunas por plot) ---
     # Começa na coluna 0, cada um com colspan=3
-    ax5 = plt.subplot2grid((3, 6), (2, 0), colspan=3) # NIR
-    ax6 = plt.subplot2grid((3, 6), (2, 3), colspan=3) # NDVI         
+    ax5 = fig.add_subplot(grade[2, 0:3]) # NIR
+    ax6 = fig.add_subplot(grade[2, 3:6]) # NDVI
 
     ax0.set_title("1. Mapa de Contexto (Área Total)")
     
-    if RGB_contexto is not None and extent_contexto is not None:
+    if fundo_contexto is not None:
+        ax0.imshow(fundo_contexto.imagem, extent=fundo_contexto.extent)
+        # Entrada de legenda da Área Total (o contorno já está no fundo)
+        ax0.plot([], [], color='yellow', linewidth=2, label="Área Total")
+
+        try: 
+            shp_parcela_gdf.boundary.plot(ax=ax0, color='red', linewidth=3, label="Parcela")
+        except Exception: 
+            pass
+
+        ax0.legend(loc='lower left', fontsize=8, facecolor='white', framealpha=0.8)
+        ax0.ticklabel_format(style='plain', useOffset=False)
+
+    elif RGB_contexto is not None and extent_contexto is not None:
         ax0.imshow(RGB_contexto, extent=extent_contexto)
         
         # 1. Plotar a Área Total (Amarelo)
@@ -141,7 +996,9 @@ def gerar_plot_complexo(
         ax0.text(0.5, 0.5, "Contexto indisponível", ha='center')
 
     try:
-        rgb_par_fil = np.dstack((normalize_visual(R_par), normalize_visual(G_par), normalize_visual(B_par)))
+        rgb_par_fil = np.dstack((normalize_visual(R_par, apply_clahe=apply_clahe, valido=valido_par),
+                                 normalize_visual(G_par, apply_clahe=apply_clahe, valido=valido_par),
+                                 normalize_visual(B_par, apply_clahe=apply_clahe, valido=valido_par)))
         ax1.imshow(rgb_par_fil)
     except Exception:
         ax1.text(0.5, 0.5, "Erro no zoom RGB", ha='center')
@@ -156,11 +1013,12 @@ def gerar_plot_complexo(
     ]
 
     for data_raw, title, cmap_name, ax in plots:
+        verificar_cancelamento(cancelado)
         if "NDVI" in title:
             im = ax.imshow(data_raw, cmap=cmap_name, vmin=-0.2, vmax=1.0)
-            plt.colorbar(im, ax=ax, shrink=0.8)
+            fig.colorbar(im, ax=ax, shrink=0.8)
         else:
-            norm_data = normalize_visual(data_raw, lower_perc=2, upper_perc=98, apply_clahe=True)
+            norm_data = normalize_visual(data_raw, lower_perc=2, upper_perc=98, apply_clahe=apply_clahe, valido=valido_par)
             im = ax.imshow(norm_data, cmap=cmap_name, vmin=0, vmax=255) # Adicionado vmin/vmax para o plot
 
             label_text = "Refletância Normalizada (0-255)"
@@ -171,81 +1029,909 @@ def gerar_plot_complexo(
             # Define os ticks em intervalos de 50, garantindo que 0 e 255 sejam exibidos.
             ticks_range = [0, 50, 100, 150, 200, 255] 
             
-            plt.colorbar(im, ax=ax, shrink=0.8, ticks=ticks_range) 
+            fig.colorbar(im, ax=ax, shrink=0.8, ticks=ticks_range) 
             # -----------------------------------------------------------------
             
         ax.set_title(title)
         ax.axis('off')
 
-    try:
-        # Apenas limpando os subplots antigos na grade (3, 4) se existirem
-        fig.delaxes(plt.subplot2grid((3, 4), (2, 2))) 
-        fig.delaxes(plt.subplot2grid((3, 4), (2, 3))) 
-    except Exception: pass
-    
     # Adicionando rótulo principal (Suptitle)
-    plt.suptitle(f"Análise: {os.path.basename(shp_parcela_gdf.filepath_or_buffer)} | Data: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", fontsize=16)
+    fig.suptitle(f"Análise: {os.path.basename(shp_parcela_gdf.filepath_or_buffer)} | Data: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", fontsize=16)
 
     # 1. Usa tight_layout para ajustar o espaçamento interno e o suptitle.
-    plt.tight_layout(rect=[0, 0, 1, 0.95]) 
+    verificar_cancelamento(cancelado)
+    fig.tight_layout(rect=[0, 0, 1, 0.95]) 
     
     # 2. SOBRESCREVE OS VALORES DE CENTRALIZAÇÃO (EXECUÇÃO FINAL)
     # left = 0.09 e right = 0.838 (Ajuste fino para a direita)
     fig.subplots_adjust(left=0.09, right=0.838, wspace=0.15, hspace=0.25) 
 
+    verificar_cancelamento(cancelado)
     buf = io.BytesIO()
-    fig.savefig(buf, format="png", dpi=300, bbox_inches="tight")
-    plt.close(fig)
-
-    buf.seek(0)
-    return Image.open(buf)
-
-def preparar_contexto(raster_obj, caminho_shp_contexto):
+    if retornar_png:
+        fig.savefig(buf, format="png", dpi=dpi, bbox_inches="tight", pil_kwargs={"compress_level": compress_level})
+        return buf.getvalue()
+    fig.savefig(buf, format="raw", dpi=dpi, bbox_inches="tight")
+    # Após o savefig o renderer do canvas ainda tem o tamanho recortado pelo bbox "tight"
+    altura, largura = fig.canvas.buffer_rgba().shape[:2]
+    return Image.frombuffer("RGBA", (largura, altura), buf.getvalue(), "raw", "RGBA", 0, 1)
+
+def preparar_contexto(raster_obj, caminho_shp_contexto, max_lado=CONTEXTO_MAX_LADO, apply_clahe=True,
+                      lado_exibicao=CONTEXTO_PAINEL_PX, cancelado=None):
+    # O gdf devolvido é a versão simplificada para desenhar o contexto com lado_exibicao px
     try:
-        gdf_ctx = gpd.read_file(caminho_shp_contexto).to_crs(raster_obj.crs)
-        geom_ctx = [unary_union(gdf_ctx.geometry)]
-        Rc, Gc, Bc, extent_ctx = get_recorte_data(raster_obj, geom_ctx)
+        ctx = CACHE_GEOMETRIAS.obter(caminho_shp_contexto, raster_obj.crs)
+        geom_ctx = [ctx.exata]
+        # O contexto é exibido com no máximo max_lado px: lê já reduzido (2x de folga)
+        Rc, Gc, Bc, valido_ctx, extent_ctx = get_recorte_reduzido(raster_obj, geom_ctx, 2 * max_lado)
         if Rc is None: return None, None, None
-        rgb_ctx_norm = np.dstack((normalize_visual(Rc), normalize_visual(Gc), normalize_visual(Bc)))
+        bandas = []
+        for banda in (Rc, Gc, Bc):
+            verificar_cancelamento(cancelado)
+            bandas.append(normalize_visual(banda, apply_clahe=apply_clahe, valido=valido_ctx))
+        rgb_ctx_norm = np.dstack(bandas)
         h, w, _ = rgb_ctx_norm.shape
-        max_size = 600
+        max_size = max_lado
         scale_factor = max_size / max(h, w) if max(h,w) > 0 else 1
         if scale_factor < 1:
             rgb_resized = resize(rgb_ctx_norm, (int(h*scale_factor), int(w*scale_factor)), anti_aliasing=True, preserve_range=True).astype(np.uint8)
         else:
             rgb_resized = rgb_ctx_norm
-        return rgb_resized, extent_ctx, gdf_ctx
+        return rgb_resized, extent_ctx, ctx.exibicao_para_extent(extent_ctx, lado_exibicao)
+    except ProcessamentoCancelado:
+        raise
     except Exception as e:
         print("Erro preparar_contexto:", e)
         return None, None, None
 
-def processar_logica_geral(raster_path, shp_parcela_path, shp_contexto_path):
-
+def ler_parcela(raster, shp_parcela_path, max_lado=None):
+    # max_lado limita o recorte a uma leitura decimada (prévia rápida)
+    gdf_par = gpd.read_file(shp_parcela_path).to_crs(raster.crs)
+    geom_par = [mapping(unary_union(gdf_par.geometry))]
+    if max_lado:
+        Rp, Gp, Bp, valido, _ = get_recorte_reduzido(raster, geom_par, max_lado)
+    else:
+        Rp, Gp, Bp, valido, _ = get_recorte_data(raster, geom_par)
+    if Rp is None: raise ValueError("A parcela está fora da área do raster selecionado.")
+    gdf_par.filepath_or_buffer = shp_parcela_path
+    return gdf_par, Rp, Gp, Bp, valido
+
+def calcular_nir_ndvi(R, G, valido, coef_a=COEF_A, coef_b=COEF_B):
+    # Único ponto em que as bandas viram float; fora de `valido` NIR/NDVI ficam NaN (só para exibição)
+    G_f = G.astype(np.float32)
+    NIR_est = (np.float32(coef_a) - G_f) / np.float32(coef_b)
+    NIR_est[~valido] = np.nan
+    NDVI = np.full(R.shape, np.nan, dtype=np.float32)
+    np.divide(NIR_est - R, NIR_est + R + np.float32(1e-9), out=NDVI, where=valido)
+    return NIR_est, NDVI
+
+def processar_logica_geral(raster_path, shp_parcela_path, shp_contexto_path, opcoes=None, cancelado=None, rapido=False):
+    """Figura completa de uma parcela.
+
+    rapido=True gera a prévia: parcela lida decimada (PREVIA_MAX_LADO), esticamento por percentis
+    sem CLAHE e PREVIA_DPI. `cancelado` (callable) é consultado entre as etapas; se devolver True,
+    levanta ProcessamentoCancelado.
+    """
+    with ambiente_gdal(opcoes):
+        return _processar_logica_geral(raster_path, shp_parcela_path, shp_contexto_path, opcoes, cancelado, rapido)
+
+def _processar_logica_geral(raster_path, shp_parcela_path, shp_contexto_path, opcoes, cancelado=None, rapido=False):
     try:
-        raster = rasterio.open(raster_path)
+        raster = abrir_raster(raster_path, opcoes)
     except Exception as e:
         raise FileNotFoundError(f"Não foi possível abrir o TIFF: {e}")
 
     with raster:
         if raster.crs is None: raise ValueError("O TIFF não tem CRS definido.")
-        rgb_ctx, extent_ctx, gdf_ctx = preparar_contexto(raster, shp_contexto_path)
-        gdf_par = gpd.read_file(shp_parcela_path).to_crs(raster.crs)
-        geom_par = [mapping(unary_union(gdf_par.geometry))]
-        Rp, Gp, Bp, _ = get_recorte_data(raster, geom_par)
-        if Rp is None: raise ValueError("A parcela está fora da área do raster selecionado.")
-        with np.errstate(divide='ignore', invalid='ignore'):
-            NIR_est = (COEF_A - Gp) / COEF_B
-            NDVI = (NIR_est - Rp) / (NIR_est + Rp + 1e-9)
-        NIR_est[np.isnan(Gp)] = np.nan
-        NDVI[~np.isfinite(NDVI)] = np.nan
-        gdf_par.filepath_or_buffer = shp_parcela_path 
+        if rapido:
+            rgb_ctx, extent_ctx, gdf_ctx = preparar_contexto(raster, shp_contexto_path, PREVIA_MAX_LADO, apply_clahe=False,
+                                                             lado_exibicao=CONTEXTO_PAINEL_PX * PREVIA_DPI // 300,
+                                                             cancelado=cancelado)
+        else:
+            rgb_ctx, extent_ctx, gdf_ctx = preparar_contexto(raster, shp_contexto_path, cancelado=cancelado)
+        verificar_cancelamento(cancelado)
+        gdf_par, Rp, Gp, Bp, valido = ler_parcela(raster, shp_parcela_path, PREVIA_MAX_LADO if rapido else None)
+        verificar_cancelamento(cancelado)
+        NIR_est, NDVI = calcular_nir_ndvi(Rp, Gp, valido)
         imagem = gerar_plot_complexo(
-            Rp, Gp, Bp, NIR_est, NDVI,
+            Rp, Gp, Bp, NIR_est, NDVI, valido,
             rgb_ctx, extent_ctx,
-            gdf_ctx, gdf_par
+            gdf_ctx, gdf_par,
+            cancelado=cancelado,
+            **({"dpi": PREVIA_DPI, "apply_clahe": False} if rapido else {})
         )
+        verificar_cancelamento(cancelado)
         return imagem
-        
+
+def gerar_previa_contexto(raster_path, shp_parcela_path, shp_contexto_path, opcoes=None, cancelado=None):
+    """Miniatura do contexto (leitura decimada, sem CLAHE) com o contorno da parcela, se houver."""
+    with ambiente_gdal(opcoes), abrir_raster(raster_path, opcoes) as src:
+        if src.count < 3: raise ValueError("Raster precisa de 3 bandas (RGB).")
+        ctx = CACHE_GEOMETRIAS.obter(shp_contexto_path, src.crs)
+        R, G, B, valido, extent = get_recorte_reduzido(src, [ctx.exata], PREVIA_MAX_LADO)
+        if R is None: raise ValueError("O contexto está fora da área do raster selecionado.")
+        verificar_cancelamento(cancelado)
+        rgb = np.dstack([normalize_visual(b, apply_clahe=False, valido=valido) for b in (R, G, B)])
+
+        fig = Figure(figsize=(4, 4))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        ax.imshow(rgb, extent=extent, vmin=0, vmax=255)
+        ax.axis('off')
+        if shp_parcela_path and os.path.exists(shp_parcela_path):
+            gpd.read_file(shp_parcela_path).to_crs(src.crs).boundary.plot(ax=ax, color='red', linewidth=3)
+        ax.set_xlim(extent[0], extent[1])
+        ax.set_ylim(extent[2], extent[3])
+        fig.tight_layout(pad=0)
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png', bbox_inches='tight', pad_inches=0)
+        buf.seek(0)
+        return Image.open(buf)
+
+# =========================
+# ESTATÍSTICAS
+# =========================
+def calcular_estatisticas(arr, valido):
+    valid = arr[valido]
+    if valid.size == 0: return [np.nan]*7
+    p25, p50, p75 = np.percentile(valid, [25, 50, 75])
+    return [float(valid.mean()), float(p50), float(valid.std()),
+            float(valid.min()), float(valid.max()), float(p25), float(p75)]
+
+def linha_relatorio(nome_parcela, R, G, B, NDVI, valido):
+    row = {"Parcela": nome_parcela}
+    for prefixo, arr in (("R", R), ("G", G), ("B", B), ("NDVI", NDVI)):
+        row.update({f"{prefixo}_{k}": v for k, v in zip(STATS_COLUNAS, calcular_estatisticas(arr, valido))})
+    return row
+
+# =========================
+# ARMAZÉM DE PIXELS / RECALIBRAÇÃO
+# =========================
+class ArmazemPixels:
+    """Pixels R/G recortados e máscara de validade de cada parcela, para recalibrar sem reler o raster.
+
+    Os dados ficam concatenados em pixels.bin (lido via np.memmap) e indice.json guarda, por
+    parcela, o dtype, as dimensões e os offsets de R, G e da máscara (np.packbits).
+    """
+    def __init__(self, pasta):
+        self.pasta = pasta
+        self.caminho_dados = os.path.join(pasta, "pixels.bin")
+        self.caminho_indice = os.path.join(pasta, "indice.json")
+        self.indice = None
+        self._arquivo = None
+        self._dados = None
+
+    @classmethod
+    def criar(cls, pasta):
+        # Um lote novo substitui o armazém anterior da pasta
+        armazem = cls(pasta)
+        if os.path.isdir(pasta): shutil.rmtree(pasta)
+        os.makedirs(pasta)
+        armazem._arquivo = open(armazem.caminho_dados, "wb")
+        armazem.indice = {"versao": ARMAZEM_VERSAO, "criado_em": datetime.now().isoformat(timespec="seconds"),
+                          "coef_a": COEF_A, "coef_b": COEF_B, "parcelas": []}
+        return armazem
+
+    @classmethod
+    def abrir(cls, pasta):
+        armazem = cls(pasta)
+        with open(armazem.caminho_indice, 'r') as f:
+            armazem.indice = json.load(f)
+        if armazem.indice.get("versao") != ARMAZEM_VERSAO:
+            raise ValueError(f"Versão de armazém não suportada: {armazem.indice.get('versao')}")
+        if os.path.getsize(armazem.caminho_dados) > 0:
+            armazem._dados = np.memmap(armazem.caminho_dados, dtype=np.uint8, mode='r')
+        return armazem
+
+    def _escrever(self, arr):
+        # Alinha cada bloco em 16 bytes para as views uint16 ficarem alinhadas
+        pos = self._arquivo.tell()
+        if pos % 16: self._arquivo.write(b"\0" * (16 - pos % 16))
+        offset = self._arquivo.tell()
+        self._arquivo.write(np.ascontiguousarray(arr).tobytes())
+        return offset
+
+    def adicionar(self, nome, R, G, valido):
+        self.indice["parcelas"].append({
+            "nome": nome, "dtype": R.dtype.str, "shape": list(R.shape),
+            "r": self._escrever(R), "g": self._escrever(G.astype(R.dtype, copy=False)),
+            "mascara": self._escrever(np.packbits(valido)),
+        })
+
+    def fechar(self):
+        if self._arquivo is None: return
+        self._arquivo.close()
+        self._arquivo = None
+        tmp = self.caminho_indice + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.indice, f)
+        os.replace(tmp, self.caminho_indice)
+
+    def ler(self, entrada):
+        dtype = np.dtype(entrada["dtype"])
+        h, w = entrada["shape"]
+        n = h * w
+        R = self._dados[entrada["r"]:entrada["r"] + n * dtype.itemsize].view(dtype).reshape(h, w)
+        G = self._dados[entrada["g"]:entrada["g"] + n * dtype.itemsize].view(dtype).reshape(h, w)
+        bits = self._dados[entrada["mascara"]:entrada["mascara"] + (n + 7) // 8]
+        valido = np.unpackbits(bits, count=n).reshape(h, w).astype(bool)
+        return R, G, valido
+
+    def __iter__(self):
+        for entrada in self.indice["parcelas"]:
+            yield entrada["nome"], self.ler(entrada)
+
+def recalibrar_armazem(pasta_armazem, coef_a=COEF_A, coef_b=COEF_B,
+                       mvlf_angular=MVLF_COEF_ANGULAR, mvlf_intercepto=MVLF_INTERCEPTO):
+    """Recalcula NIR, NDVI, estatísticas e MVLF de todas as parcelas a partir do armazém de pixels."""
+    armazem = ArmazemPixels.abrir(pasta_armazem)
+    rows = []
+    for nome, (R, G, valido) in armazem:
+        # Só os pixels válidos entram no cálculo: vetores 1D, sem NaN
+        R_v = R[valido].astype(np.float32)
+        NIR_v = (np.float32(coef_a) - G[valido].astype(np.float32)) / np.float32(coef_b)
+        NDVI_v = (NIR_v - R_v) / (NIR_v + R_v + np.float32(1e-9))
+        tudo = np.ones(NDVI_v.shape, dtype=bool)
+        row = {"Parcela": nome}
+        for prefixo, arr in (("R", R_v), ("G", G[valido]), ("NIR", NIR_v), ("NDVI", NDVI_v)):
+            row.update({f"{prefixo}_{k}": v for k, v in zip(STATS_COLUNAS, calcular_estatisticas(arr, tudo))})
+        row["MVLF_kg_ha"] = calcular_mvlf(row["NDVI_p25"], mvlf_angular, mvlf_intercepto) if NDVI_v.size else np.nan
+        rows.append(row)
+    return rows
+
+# =========================
+# PIPELINE EM LOTE
+# =========================
+_FIM_FILA = object()
+
+def executar_pipeline(fonte, processar, gravar=None, profundidade=PIPELINE_PROFUNDIDADE_PADRAO, ao_progredir=None):
+    """Executa leitura -> processamento -> gravação em estágios com filas limitadas.
+
+    `fonte` é um iterável de (item, dados) consumido numa thread de leitura, de modo que o
+    próximo recorte já está sendo lido enquanto o atual é calculado/renderizado. `processar`
+    roda na thread chamadora (matplotlib/Tk) e o que ele retornar (exceto None) vai para
+    `gravar`, executado numa thread de gravação. Retorna o tempo ocupado e a utilização de
+    cada estágio.
+    """
+    profundidade = max(1, int(profundidade))
+    fila_leitura = queue.Queue(maxsize=profundidade)
+    fila_gravacao = queue.Queue(maxsize=profundidade)
+    ocupado = {"leitura": 0.0, "processamento": 0.0, "gravacao": 0.0}
+    erro_fatal = []
+    parar = threading.Event()
+
+    def estagio_leitura():
+        iterador = iter(fonte)
+        try:
+            while not parar.is_set():
+                t0 = time.perf_counter()
+                try:
+                    item = next(iterador)
+                except StopIteration:
+                    break
+                finally:
+                    ocupado["leitura"] += time.perf_counter() - t0
+                fila_leitura.put(item)
+        except Exception as e:
+            erro_fatal.append(e)
+        finally:
+            fila_leitura.put(_FIM_FILA)
+
+    def estagio_gravacao():
+        while True:
+            item = fila_gravacao.get()
+            if item is _FIM_FILA: break
+            t0 = time.perf_counter()
+            try:
+                gravar(*item)
+            except Exception as e:
+                print(f"Erro gravando {item[0]}: {e}")
+            ocupado["gravacao"] += time.perf_counter() - t0
+
+    inicio = time.perf_counter()
+    leitor = threading.Thread(target=estagio_leitura, name="pipeline-leitura", daemon=True)
+    gravador = threading.Thread(target=estagio_gravacao, name="pipeline-gravacao", daemon=True) if gravar else None
+    leitor.start()
+    if gravador: gravador.start()
+
+    n_itens = 0
+    try:
+        while True:
+            item = fila_leitura.get()
+            if item is _FIM_FILA: break
+            chave, dados = item
+            t0 = time.perf_counter()
+            resultado = processar(chave, dados)
+            ocupado["processamento"] += time.perf_counter() - t0
+            if gravador and resultado is not None:
+                fila_gravacao.put((chave, resultado))
+            n_itens += 1
+            if ao_progredir: ao_progredir(n_itens)
+    finally:
+        if gravador:
+            fila_gravacao.put(_FIM_FILA)
+            gravador.join()
+        # Em caso de erro no processamento, esvazia a fila para a leitura não ficar bloqueada
+        parar.set()
+        while leitor.is_alive():
+            try: fila_leitura.get(timeout=0.1)
+            except queue.Empty: pass
+
+    if erro_fatal: raise erro_fatal[0]
+
+    total = time.perf_counter() - inicio
+    relatorio = {"itens": n_itens, "tempo_total": total, "profundidade": profundidade}
+    for estagio, t in ocupado.items():
+        if estagio == "gravacao" and not gravar: continue
+        relatorio[estagio] = {"ocupado": t, "utilizacao": (t / total) if total > 0 else 0.0}
+    return relatorio
+
+def formatar_relatorio_pipeline(rel):
+    partes = [f"{rel['itens']} itens em {rel['tempo_total']:.1f}s (fila={rel['profundidade']})"]
+    if "contexto" in rel:
+        partes.append(f"contexto: {rel['contexto']:.1f}s")
+    for estagio in ("leitura", "processamento", "gravacao"):
+        if estagio not in rel: continue
+        partes.append(f"{estagio}: {rel[estagio]['utilizacao']*100:.0f}% ({rel[estagio]['ocupado']:.1f}s)")
+    if "mascaras" in rel:
+        partes.append(formatar_resumo_mascaras(rel["mascaras"]))
+    if "gdal" in rel:
+        partes.append(formatar_opcoes_gdal(rel["gdal"]))
+    return " | ".join(partes)
+
+def processar_lote(pasta, arquivos, raster_path, shp_contexto_path, salvar_csv=False, opcoes=None,
+                   profundidade=PIPELINE_PROFUNDIDADE_PADRAO, ao_progredir=None, armazem=None):
+    """Gera Resultado_<parcela>.png para cada shapefile de `arquivos` (em `pasta`).
+
+    Com `armazem` (ArmazemPixels), guarda também os pixels R/G e a máscara de cada parcela.
+    Retorna (relatório do pipeline, linhas do CSV consolidado).
+    """
+    opcoes = opcoes or opcoes_gdal({})
+    csv_rows = []
+    mascaras_inicio = CACHE_MASCARAS.contadores()
+
+    with ambiente_gdal(opcoes):
+        t_ctx = time.perf_counter()
+        with abrir_raster(raster_path, opcoes) as ds_ctx:
+            if ds_ctx.crs is None: raise ValueError("O TIFF não tem CRS definido.")
+            rgb_ctx, extent_ctx, gdf_ctx = preparar_contexto(ds_ctx, shp_contexto_path)
+        # Painel de contexto rasterizado uma vez por lote; cada parcela só desenha o contorno vermelho
+        fundo_ctx = renderizar_fundo_contexto(rgb_ctx, extent_ctx, gdf_ctx)
+        t_ctx = time.perf_counter() - t_ctx
+
+        def processar(shp, dados):
+            if isinstance(dados, Exception):
+                print(f"Erro processando {shp}: {dados}")
+                return None
+            gdf_par, Rp, Gp, Bp, valido = dados
+            NIR_est, NDVI = calcular_nir_ndvi(Rp, Gp, valido)
+            if armazem is not None:
+                armazem.adicionar(os.path.splitext(shp)[0], Rp, Gp, valido)
+            if salvar_csv:
+                try:
+                    csv_rows.append(linha_relatorio(os.path.splitext(shp)[0], Rp, Gp, Bp, NDVI, valido))
+                except Exception as e:
+                    print(f"Erro stats {shp}: {e}")
+            try:
+                imagem = gerar_plot_complexo(
+                    Rp, Gp, Bp, NIR_est, NDVI, valido,
+                    rgb_ctx, extent_ctx,
+                    gdf_ctx, gdf_par,
+                    fundo_contexto=fundo_ctx
+                )
+            except Exception as e:
+                print(f"Erro processando {shp}: {e}")
+                return None
+            return imagem
+
+        def gravar(shp, imagem):
+            # Única codificação PNG da figura: o estágio de cálculo entrega o buffer RGBA bruto
+            imagem.save(os.path.join(pasta, f"Resultado_{os.path.splitext(shp)[0]}.png"))
+
+        rel = executar_pipeline(
+            gerar_leituras_parcelas(raster_path, pasta, arquivos, opcoes),
+            processar, gravar,
+            profundidade=profundidade, ao_progredir=ao_progredir
+        )
+    rel["contexto"] = t_ctx
+    rel["gdal"] = opcoes
+    rel["mascaras"] = CACHE_MASCARAS.resumo(desde=mascaras_inicio)
+    return rel, csv_rows
+
+def processar_estatisticas_lote(pasta, arquivos, raster_path, opcoes=None,
+                                profundidade=PIPELINE_PROFUNDIDADE_PADRAO, ao_progredir=None, armazem=None):
+    """Modo somente estatísticas: uma leitura mascarada por parcela, sem matplotlib nem CLAHE.
+
+    Retorna (relatório do pipeline, linhas do CSV consolidado).
+    """
+    opcoes = opcoes or opcoes_gdal({})
+    csv_rows = []
+    mascaras_inicio = CACHE_MASCARAS.contadores()
+
+    def processar(shp, dados):
+        if isinstance(dados, Exception):
+            print(f"Erro stats {shp}: {dados}")
+            return None
+        _, Rp, Gp, Bp, valido = dados
+        _, NDVI = calcular_nir_ndvi(Rp, Gp, valido)
+        if armazem is not None:
+            armazem.adicionar(os.path.splitext(shp)[0], Rp, Gp, valido)
+        csv_rows.append(linha_relatorio(os.path.splitext(shp)[0], Rp, Gp, Bp, NDVI, valido))
+        return None
+
+    with ambiente_gdal(opcoes):
+        rel = executar_pipeline(
+            gerar_leituras_parcelas(raster_path, pasta, arquivos, opcoes),
+            processar,
+            profundidade=profundidade, ao_progredir=ao_progredir
+        )
+    rel["gdal"] = opcoes
+    rel["mascaras"] = CACHE_MASCARAS.resumo(desde=mascaras_inicio)
+    return rel, csv_rows
+
+def salvar_relatorio_csv(csv_rows, pasta):
+    df = pd.DataFrame(csv_rows)
+    csv_out = os.path.join(pasta, "relatorio_consolidado_parcelas.csv")
+    df.to_csv(csv_out, index=False, float_format="%.6f")
+    return csv_out
+
+def gerar_leituras_parcelas(raster_path, pasta, arquivos, opcoes=None):
+    # Roda na thread de leitura: abre o próprio handle do raster (não compartilhado entre threads)
+    with ambiente_gdal(opcoes), abrir_raster(raster_path, opcoes) as raster:
+        if raster.crs is None: raise ValueError("O TIFF não tem CRS definido.")
+        for shp in arquivos:
+            try:
+                yield shp, ler_parcela(raster, os.path.join(pasta, shp))
+            except Exception as e:
+                yield shp, e
+
+# =========================
+# WORKERS COM RASTERS "AQUECIDOS"
+# =========================
+# Estado de cada processo do pool: handles de raster abertos e contextos já preparados,
+# reaproveitados entre itens em vez de reabrir o TIFF e redissolver o contexto a cada parcela.
+# Ambos são LRUs limitados: o processo vive o dia todo e vê rasters novos a cada voo.
+_WORKER_ESTADO = None
+
+def _inicializar_worker(opcoes, motor_clahe_pai=CLAHE_MOTOR_PADRAO,
+                        max_rasters=VIGIA_RASTERS_ABERTOS, max_contextos=VIGIA_CONTEXTOS_MAX):
+    global _WORKER_ESTADO
+    # Ctrl+C é tratado pelo processo principal, que encerra o pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    plt.switch_backend("Agg")
+    definir_motor_clahe(motor_clahe_pai)
+    # O Env vive enquanto o processo do pool existir
+    env = ambiente_gdal(opcoes)
+    env.__enter__()
+    _WORKER_ESTADO = {"opcoes": opcoes, "env": env, "rasters": OrderedDict(), "contextos": OrderedDict(),
+                      "max_rasters": max(1, max_rasters), "max_contextos": max(1, max_contextos)}
+
+def _descartar_contextos(raster_path):
+    contextos = _WORKER_ESTADO["contextos"]
+    for chave in [c for c in contextos if c[0] == raster_path]:
+        del contextos[chave]
+
+def _raster_aquecido(raster_path):
+    rasters = _WORKER_ESTADO["rasters"]
+    mtime = mtime_raster(raster_path)
+    atual = rasters.get(raster_path)
+    if atual and atual[0] == mtime:
+        rasters.move_to_end(raster_path)
+        return atual[1]
+    if atual:
+        # Raster regravado: fecha o handle antigo e esquece os contextos preparados com ele
+        del rasters[raster_path]
+        atual[1].close()
+        _descartar_contextos(raster_path)
+    ds = abrir_raster(raster_path, _WORKER_ESTADO["opcoes"])
+    if ds.crs is None:
+        ds.close()
+        raise ValueError("O TIFF não tem CRS definido.")
+    rasters[raster_path] = (mtime, ds)
+    while len(rasters) > _WORKER_ESTADO["max_rasters"]:
+        _, (_, antigo) = rasters.popitem(last=False)
+        antigo.close()
+    return ds
+
+def _contexto_aquecido(ds, raster_path, shp_contexto_path):
+    chave = (raster_path, mtime_raster(raster_path), shp_contexto_path, os.path.getmtime(shp_contexto_path))
+    contextos = _WORKER_ESTADO["contextos"]
+    if chave in contextos:
+        contextos.move_to_end(chave)
+        return contextos[chave]
+    # Versões anteriores do mesmo par (raster, contexto) nunca mais serão usadas
+    for antiga in [c for c in contextos if c[0] == raster_path and c[2] == shp_contexto_path]:
+        del contextos[antiga]
+    rgb_ctx, extent_ctx, gdf_ctx = preparar_contexto(ds, shp_contexto_path)
+    contextos[chave] = (rgb_ctx, extent_ctx, gdf_ctx, renderizar_fundo_contexto(rgb_ctx, extent_ctx, gdf_ctx))
+    while len(contextos) > _WORKER_ESTADO["max_contextos"]:
+        contextos.popitem(last=False)
+    return contextos[chave]
+
+def _worker_processar_parcela(raster_path, shp_path, shp_contexto_path=None, png_path=None):
+    """Executado no pool: estatísticas da parcela e, se png_path, a figura completa salva em disco."""
+    t0 = time.perf_counter()
+    ds = _raster_aquecido(raster_path)
+    gdf_par, Rp, Gp, Bp, valido = ler_parcela(ds, shp_path)
+    NIR_est, NDVI = calcular_nir_ndvi(Rp, Gp, valido)
+    row = linha_relatorio(os.path.splitext(os.path.basename(shp_path))[0], Rp, Gp, Bp, NDVI, valido)
+    if png_path and shp_contexto_path:
+        rgb_ctx, extent_ctx, gdf_ctx, fundo_ctx = _contexto_aquecido(ds, raster_path, shp_contexto_path)
+        imagem = gerar_plot_complexo(Rp, Gp, Bp, NIR_est, NDVI, valido, rgb_ctx, extent_ctx, gdf_ctx, gdf_par,
+                                     fundo_contexto=fundo_ctx)
+        imagem.save(png_path)
+    return row, time.perf_counter() - t0
+
+def _worker_estatisticas_parcela(raster_path, shp_path):
+    ds = _raster_aquecido(raster_path)
+    _, Rp, Gp, Bp, valido = ler_parcela(ds, shp_path)
+    _, NDVI = calcular_nir_ndvi(Rp, Gp, valido)
+    return linha_relatorio(os.path.splitext(os.path.basename(shp_path))[0], Rp, Gp, Bp, NDVI, valido)
+
+def _worker_png_parcela(raster_path, shp_path, shp_contexto_path):
+    ds = _raster_aquecido(raster_path)
+    rgb_ctx, extent_ctx, gdf_ctx, fundo_ctx = _contexto_aquecido(ds, raster_path, shp_contexto_path)
+    gdf_par, Rp, Gp, Bp, valido = ler_parcela(ds, shp_path)
+    NIR_est, NDVI = calcular_nir_ndvi(Rp, Gp, valido)
+    return gerar_plot_complexo(Rp, Gp, Bp, NIR_est, NDVI, valido, rgb_ctx, extent_ctx, gdf_ctx, gdf_par,
+                               retornar_png=True, fundo_contexto=fundo_ctx)
+
+def criar_pool_workers(n_workers, opcoes, max_rasters=VIGIA_RASTERS_ABERTOS, max_contextos=VIGIA_CONTEXTOS_MAX):
+    return ProcessPoolExecutor(max_workers=n_workers, initializer=_inicializar_worker,
+                               initargs=(opcoes, motor_clahe(), max_rasters, max_contextos))
+
+# =========================
+# MODO VIGIA (SERVIÇO)
+# =========================
+def _assinatura(caminho):
+    # Para mosaicos (pasta de tiles), o tile mais recente e o tamanho somado dos tiles
+    stats = [os.stat(a) for a in arquivos_raster(caminho)]
+    return [max(st.st_mtime for st in stats), sum(st.st_size for st in stats)]
+
+def _percentil(valores, p):
+    if not valores: return None
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+class VigiaPastas:
+    """Monitora uma pasta de parcelas e uma de rasters e processa só o trabalho novo ou alterado.
+
+    Cada par (raster, parcela) é um item; o item é refeito quando o TIFF ou o shapefile mudam.
+    Uma subpasta de `pasta_rasters` com TIFFs é tratada como um mosaico virtual.
+    Os itens vão para um pool de processos com rasters aquecidos; PNGs e linhas do relatório
+    são gravados à medida que cada item termina, e um arquivo de status registra fila e latências.
+    """
+    def __init__(self, pasta_parcelas, pasta_rasters, pasta_saida, shp_contexto=None,
+                 opcoes=None, n_workers=None, intervalo=VIGIA_INTERVALO_S, somente_stats=False):
+        self.pasta_parcelas = pasta_parcelas
+        self.pasta_rasters = pasta_rasters
+        self.pasta_saida = pasta_saida
+        self.shp_contexto = shp_contexto
+        self.opcoes = opcoes or opcoes_gdal({})
+        self.n_workers = n_workers or max(1, (os.cpu_count() or 2) - 1)
+        self.intervalo = intervalo
+        self.somente_stats = somente_stats or not shp_contexto
+
+        os.makedirs(pasta_saida, exist_ok=True)
+        self.caminho_estado = os.path.join(pasta_saida, VIGIA_ESTADO_ARQUIVO)
+        self.caminho_status = os.path.join(pasta_saida, VIGIA_STATUS_ARQUIVO)
+        self.caminho_relatorio = os.path.join(pasta_saida, VIGIA_RELATORIO_ARQUIVO)
+        self.concluidos = {}
+        if os.path.exists(self.caminho_estado):
+            try:
+                with open(self.caminho_estado, 'r') as f:
+                    self.concluidos = json.load(f)
+            except Exception as e:
+                print(f"Estado do vigia inválido, recomeçando: {e}")
+
+        self.catalogo = CatalogoParcelas(pasta_parcelas)
+        self.footprints = {}  # raster -> (assinatura, crs, bounds)
+        self.pendentes = deque()
+        self.em_execucao = {}
+        self.enfileirados = set()
+        self.falhas = {}  # chave -> (assinatura, instante): só em memória, nunca vai para o estado
+        self.latencias = deque(maxlen=1000)
+        self.tempos_proc = deque(maxlen=1000)
+        self.n_concluidos = 0
+        self.n_erros = 0
+        self.inicio = time.time()
+
+    def _estavel(self, caminho):
+        return time.time() - os.path.getmtime(caminho) >= VIGIA_ESTABILIZACAO_S
+
+    def _raster_pronto(self, raster_path):
+        # Arquivo único ou todos os tiles do mosaico sem alteração recente
+        return all(self._estavel(t) for t in arquivos_raster(raster_path))
+
+    def _listar_rasters(self):
+        rasters = []
+        for f in sorted(os.listdir(self.pasta_rasters)):
+            caminho = os.path.join(self.pasta_rasters, f)
+            if os.path.isdir(caminho):
+                if any(t.lower().endswith(MOSAICO_EXTENSOES) for t in os.listdir(caminho)):
+                    rasters.append(caminho)
+            elif f.lower().endswith(MOSAICO_EXTENSOES):
+                rasters.append(caminho)
+        return rasters
+
+    def _parcela_pronta(self, nome):
+        # Todos os componentes obrigatórios presentes e nenhum componente alterado recentemente
+        componentes = componentes_shapefile(os.path.join(self.pasta_parcelas, nome))
+        if any(ext not in componentes for ext in SHAPEFILE_OBRIGATORIOS): return False
+        return all(self._estavel(c) for c in componentes.values())
+
+    def _footprint(self, raster_path):
+        assinatura = _assinatura(raster_path)
+        atual = self.footprints.get(raster_path)
+        if atual and atual[0] == assinatura: return atual[1], atual[2]
+        with ambiente_gdal(self.opcoes), abrir_raster(raster_path, self.opcoes) as ds:
+            crs, bounds = ds.crs, ds.bounds
+        self.footprints[raster_path] = (assinatura, crs, bounds)
+        return crs, bounds
+
+    def varrer(self):
+        parcelas = [n for n in self.catalogo.atualizar() if self._parcela_pronta(n)]
+        novos = 0
+        for raster_path in self._listar_rasters():
+            try:
+                if not self._raster_pronto(raster_path): continue
+                crs, bounds = self._footprint(raster_path)
+                sig_raster = _assinatura(raster_path)
+            except Exception as e:
+                print(f"Erro lendo {raster_path}: {e}")
+                continue
+            candidatas = self.catalogo.filtrar_por_raster(parcelas, crs, bounds)[0] if crs else parcelas
+            for nome in candidatas:
+                chave = f"{os.path.basename(raster_path)}|{nome}"
+                meta = self.catalogo.entradas[nome]
+                assinatura = sig_raster + [meta["mtime"], meta["tamanho"]]
+                if chave in self.enfileirados or self.concluidos.get(chave) == assinatura: continue
+                falha = self.falhas.get(chave)
+                if falha and falha[0] == assinatura and time.time() - falha[1] < VIGIA_RETENTATIVA_S: continue
+                self.pendentes.append((chave, raster_path, nome, assinatura, time.time()))
+                self.enfileirados.add(chave)
+                novos += 1
+        if novos:
+            print(f"[vigia] {novos} item(ns) novo(s) na fila ({len(self.pendentes)} pendentes)")
+
+    def _submeter(self, pool):
+        while self.pendentes and len(self.em_execucao) < 2 * self.n_workers:
+            chave, raster_path, nome, assinatura, t_fila = self.pendentes.popleft()
+            png_path = None
+            if not self.somente_stats:
+                nome_raster = os.path.splitext(os.path.basename(raster_path))[0]
+                png_path = os.path.join(self.pasta_saida, f"Resultado_{os.path.splitext(nome)[0]}__{nome_raster}.png")
+            futuro = pool.submit(_worker_processar_parcela, raster_path,
+                                 os.path.join(self.pasta_parcelas, nome), self.shp_contexto, png_path)
+            self.em_execucao[futuro] = (chave, raster_path, assinatura, t_fila)
+
+    def _concluir(self, futuro):
+        chave, raster_path, assinatura, t_fila = self.em_execucao.pop(futuro)
+        self.enfileirados.discard(chave)
+        try:
+            row, t_proc = futuro.result()
+        except Exception as e:
+            self.n_erros += 1
+            print(f"[vigia] Erro em {chave}: {e}")
+            # Não conta como concluído: tenta de novo quando os arquivos mudarem ou após VIGIA_RETENTATIVA_S
+            self.falhas[chave] = (assinatura, time.time())
+            return
+        self.falhas.pop(chave, None)
+        self.n_concluidos += 1
+        self.latencias.append(time.time() - t_fila)
+        self.tempos_proc.append(t_proc)
+        self.concluidos[chave] = assinatura
+        row = {"Raster": os.path.basename(raster_path), "Concluido_em": datetime.now().isoformat(timespec="seconds"), **row}
+        novo = not os.path.exists(self.caminho_relatorio)
+        with open(self.caminho_relatorio, 'a', newline='') as f:
+            escritor = csv.DictWriter(f, fieldnames=list(row))
+            if novo: escritor.writeheader()
+            escritor.writerow(row)
+
+    def _salvar_json(self, caminho, dados):
+        tmp = caminho + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(dados, f, indent=2)
+        os.replace(tmp, caminho)
+
+    def salvar_status(self):
+        lat = list(self.latencias)
+        proc = list(self.tempos_proc)
+        self._salvar_json(self.caminho_status, {
+            "atualizado_em": datetime.now().isoformat(timespec="seconds"),
+            "ativo_desde_s": round(time.time() - self.inicio, 1),
+            "fila": len(self.pendentes),
+            "em_execucao": len(self.em_execucao),
+            "concluidos": self.n_concluidos,
+            "erros": self.n_erros,
+            "workers": self.n_workers,
+            "latencia_s": {
+                "media": (sum(lat) / len(lat)) if lat else None,
+                "p50": _percentil(lat, 50), "p95": _percentil(lat, 95), "max": max(lat) if lat else None,
+            },
+            "processamento_medio_s": (sum(proc) / len(proc)) if proc else None,
+        })
+
+    def executar(self):
+        print(f"[vigia] Monitorando {self.pasta_parcelas} e {self.pasta_rasters} ({self.n_workers} workers). Ctrl+C para sair.")
+        proxima_varredura = 0.0
+        with criar_pool_workers(self.n_workers, self.opcoes) as pool:
+            try:
+                while True:
+                    if time.time() >= proxima_varredura:
+                        try:
+                            self.varrer()
+                        except Exception as e:
+                            print(f"[vigia] Erro na varredura: {e}")
+                        proxima_varredura = time.time() + self.intervalo
+                    self._submeter(pool)
+                    if self.em_execucao:
+                        prontos, _ = wait(list(self.em_execucao), timeout=1.0, return_when=FIRST_COMPLETED)
+                        for futuro in prontos:
+                            self._concluir(futuro)
+                        if prontos:
+                            self._salvar_json(self.caminho_estado, self.concluidos)
+                    else:
+                        time.sleep(min(1.0, max(0.0, proxima_varredura - time.time())))
+                    self.salvar_status()
+            except KeyboardInterrupt:
+                print("[vigia] Encerrando...")
+                for futuro in list(self.em_execucao):
+                    futuro.cancel()
+            finally:
+                self._salvar_json(self.caminho_estado, self.concluidos)
+                self.salvar_status()
+
+# =========================
+# SERVIÇO HTTP LOCAL
+# =========================
+class MetricasLatencia:
+    """Histogramas de latência (buckets cumulativos, em segundos) por endpoint."""
+    def __init__(self, buckets=SERVICO_BUCKETS_S):
+        self.buckets = list(buckets)
+        self._lock = threading.Lock()
+        self._dados = {}
+
+    def registrar(self, endpoint, status, segundos):
+        with self._lock:
+            d = self._dados.setdefault(endpoint, {"contagem": 0, "soma_s": 0.0, "max_s": 0.0,
+                                                  "buckets": [0] * (len(self.buckets) + 1), "status": {}})
+            d["contagem"] += 1
+            d["soma_s"] += segundos
+            d["max_s"] = max(d["max_s"], segundos)
+            for i, limite in enumerate(self.buckets):
+                if segundos <= limite: d["buckets"][i] += 1
+            d["buckets"][-1] += 1
+            d["status"][str(status)] = d["status"].get(str(status), 0) + 1
+
+    def exportar(self):
+        with self._lock:
+            saida = {}
+            for endpoint, d in self._dados.items():
+                rotulos = [f"le_{b}" for b in self.buckets] + ["le_inf"]
+                saida[endpoint] = {
+                    "contagem": d["contagem"], "soma_s": d["soma_s"], "max_s": d["max_s"],
+                    "media_s": d["soma_s"] / d["contagem"] if d["contagem"] else None,
+                    "histograma": dict(zip(rotulos, d["buckets"])), "status": dict(d["status"]),
+                }
+            return saida
+
+def valores_json(valor):
+    # NaN/inf (ex.: estatísticas de parcela sem pixels válidos) viram null: JSON estrito não os aceita
+    if isinstance(valor, dict): return {k: valores_json(v) for k, v in valor.items()}
+    if isinstance(valor, (list, tuple)): return [valores_json(v) for v in valor]
+    if isinstance(valor, np.integer): return int(valor)
+    if isinstance(valor, (float, np.floating)):
+        return float(valor) if math.isfinite(valor) else None
+    return valor
+
+class ServicoProcessamento:
+    """Serviço HTTP local sobre o pool de workers com rasters aquecidos.
+
+    GET /analise?raster=...&parcela=...&contexto=...  -> PNG da análise completa
+    GET /estatisticas?raster=...&parcela=...          -> JSON com as estatísticas R/G/B/NDVI
+    GET /metricas                                     -> JSON com histogramas de latência
+    GET /saude                                        -> JSON {"ok": true}
+
+    O paralelismo é limitado pelo pool; no máximo SERVICO_FILA_POR_WORKER requisições por
+    worker são admitidas ao mesmo tempo, as demais recebem 503.
+    """
+    def __init__(self, host=SERVICO_HOST, porta=SERVICO_PORTA, n_workers=None, opcoes=None):
+        self.n_workers = n_workers or max(1, (os.cpu_count() or 2) - 1)
+        self.opcoes = opcoes or opcoes_gdal({})
+        self.metricas = MetricasLatencia()
+        self.vagas = threading.BoundedSemaphore(self.n_workers * SERVICO_FILA_POR_WORKER)
+        self.em_andamento = 0
+        self._lock = threading.Lock()
+        self.pool = None
+        self.servidor = ThreadingHTTPServer((host, porta), self._criar_handler())
+        self.servidor.daemon_threads = True
+
+    def _criar_handler(self):
+        servico = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, fmt, *args):
+                pass
+
+            def _responder(self, status, corpo, tipo):
+                self.send_response(status)
+                self.send_header("Content-Type", tipo)
+                self.send_header("Content-Length", str(len(corpo)))
+                self.end_headers()
+                self.wfile.write(corpo)
+
+            def _json(self, status, dados):
+                self._responder(status, json.dumps(valores_json(dados), ensure_ascii=False, allow_nan=False, default=float).encode("utf-8"),
+                                "application/json; charset=utf-8")
+
+            def do_GET(self):
+                t0 = time.perf_counter()
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                status = servico.atender(self, url.path, params)
+                servico.metricas.registrar(url.path, status, time.perf_counter() - t0)
+
+        return Handler
+
+    def atender(self, handler, caminho, params):
+        if caminho == "/saude":
+            handler._json(200, {"ok": True})
+            return 200
+        if caminho == "/metricas":
+            with self._lock: em_andamento = self.em_andamento
+            handler._json(200, {"workers": self.n_workers, "em_andamento": em_andamento,
+                                "latencia": self.metricas.exportar()})
+            return 200
+        if caminho not in ("/analise", "/estatisticas"):
+            handler._json(404, {"erro": f"Endpoint desconhecido: {caminho}"})
+            return 404
+
+        obrigatorios = ["raster", "parcela"] + (["contexto"] if caminho == "/analise" else [])
+        faltando = [p for p in obrigatorios if not params.get(p)]
+        if faltando:
+            handler._json(400, {"erro": f"Parâmetros obrigatórios ausentes: {', '.join(faltando)}"})
+            return 400
+        inexistentes = rasters_inexistentes(params["raster"])
+        inexistentes += [params[p] for p in obrigatorios if p != "raster" and not os.path.exists(params[p])]
+        if inexistentes:
+            handler._json(404, {"erro": f"Arquivo(s) não encontrado(s): {', '.join(inexistentes)}"})
+            return 404
+
+        if not self.vagas.acquire(blocking=False):
+            handler._json(503, {"erro": "Serviço ocupado, tente novamente"})
+            return 503
+        with self._lock: self.em_andamento += 1
+        try:
+            if caminho == "/analise":
+                png = self.pool.submit(_worker_png_parcela, params["raster"], params["parcela"], params["contexto"]).result()
+                handler._responder(200, png, "image/png")
+            else:
+                row = self.pool.submit(_worker_estatisticas_parcela, params["raster"], params["parcela"]).result()
+                handler._json(200, row)
+            return 200
+        except ValueError as e:
+            handler._json(422, {"erro": str(e)})
+            return 422
+        except Exception as e:
+            handler._json(500, {"erro": str(e)})
+            return 500
+        finally:
+            with self._lock: self.em_andamento -= 1
+            self.vagas.release()
+
+    def executar(self):
+        host, porta = self.servidor.server_address[:2]
+        print(f"[servico] Escutando em http://{host}:{porta} ({self.n_workers} workers). Ctrl+C para sair.")
+        with criar_pool_workers(self.n_workers, self.opcoes,
+                                SERVICO_RASTERS_ABERTOS, SERVICO_CONTEXTOS_MAX) as pool:
+            self.pool = pool
+            try:
+                self.servidor.serve_forever()
+            except KeyboardInterrupt:
+                print("[servico] Encerrando...")
+            finally:
+                self.servidor.server_close()
 
 # =========================
 # GUI 
@@ -262,6 +1948,7 @@ class App(tk.Tk):
 
         # --- Carregar Configurações ---
         self.settings = self.load_settings()
+        definir_motor_clahe(self.settings.get("clahe_engine", CLAHE_MOTOR_PADRAO))
         
         if self.settings.get("fullscreen", False):
             self.attributes('-fullscreen', True)
@@ -334,18 +2021,7 @@ class App(tk.Tk):
         frame.tkraise()
 
     def load_settings(self):
-        default_settings = {
-            "fullscreen": False,
-            "remember_last_dir": True,
-            "default_dir": os.path.expanduser("~")
-        }
-        if os.path.exists(CONFIG_FILE):
-            try:
-                with open(CONFIG_FILE, 'r') as f:
-                    return json.load(f)
-            except:
-                return default_settings
-        return default_settings
+        return carregar_settings()
 
     def save_settings(self):
         if self.settings.get("remember_last_dir", True):
@@ -434,6 +2110,52 @@ class SettingsPage(Frame):
         Label(self, textvariable=self.var_default_dir, foreground='#6aa84f', wraplength=400).grid(row=row, column=1, sticky='w', pady=(0, 10))
         row += 1
 
+        Separator(self, orient='horizontal').grid(row=row, column=0, columnspan=3, sticky='ew', padx=40, pady=15)
+        row += 1
+
+        self.var_queue_depth = tk.IntVar(value=controller.settings.get("pipeline_queue_depth", PIPELINE_PROFUNDIDADE_PADRAO))
+        Label(self, text="Profundidade da fila do lote (parcelas pré-carregadas):").grid(row=row, column=1, sticky='w', pady=(5,0))
+        row += 1
+        sp_depth = Spinbox(self, from_=1, to=16, textvariable=self.var_queue_depth, width=6, command=self.save_changes)
+        sp_depth.grid(row=row, column=1, sticky='w', pady=5)
+        sp_depth.bind("<FocusOut>", lambda e: self.save_changes())
+        row += 1
+
+        # --- Desempenho GDAL/rasterio (aplicado via rasterio.Env em todo o processamento) ---
+        self.var_gdal_cache = tk.IntVar(value=controller.settings.get("gdal_cache_mb", GDAL_CACHE_MB_PADRAO))
+        self.var_gdal_threads = tk.StringVar(value=str(controller.settings.get("gdal_num_threads", GDAL_THREADS_PADRAO)))
+        self.var_gdal_overviews = tk.StringVar(value=controller.settings.get("gdal_overview_policy", GDAL_OVERVIEWS_PADRAO))
+
+        Label(self, text="Cache de blocos GDAL (MB):").grid(row=row, column=1, sticky='w', pady=(5,0))
+        row += 1
+        sp_cache = Spinbox(self, from_=64, to=16384, increment=64, textvariable=self.var_gdal_cache, width=8, command=self.save_changes)
+        sp_cache.grid(row=row, column=1, sticky='w', pady=5)
+        sp_cache.bind("<FocusOut>", lambda e: self.save_changes())
+        row += 1
+
+        Label(self, text="Threads de descompressão GDAL:").grid(row=row, column=1, sticky='w', pady=(5,0))
+        row += 1
+        cb_threads = Combobox(self, textvariable=self.var_gdal_threads, values=["ALL_CPUS", "1", "2", "4", "8"], width=10)
+        cb_threads.grid(row=row, column=1, sticky='w', pady=5)
+        cb_threads.bind("<<ComboboxSelected>>", lambda e: self.save_changes())
+        cb_threads.bind("<FocusOut>", lambda e: self.save_changes())
+        row += 1
+
+        Label(self, text="Uso de overviews (auto = leituras reduzidas usam overviews):").grid(row=row, column=1, sticky='w', pady=(5,0))
+        row += 1
+        cb_ovr = Combobox(self, textvariable=self.var_gdal_overviews, values=list(POLITICAS_OVERVIEW), state='readonly', width=10)
+        cb_ovr.grid(row=row, column=1, sticky='w', pady=5)
+        cb_ovr.bind("<<ComboboxSelected>>", lambda e: self.save_changes())
+        row += 1
+
+        self.var_clahe_engine = tk.StringVar(value=controller.settings.get("clahe_engine", CLAHE_MOTOR_PADRAO))
+        Label(self, text="Motor do CLAHE (skimage = original, inteiro = rápido):").grid(row=row, column=1, sticky='w', pady=(5,0))
+        row += 1
+        cb_clahe = Combobox(self, textvariable=self.var_clahe_engine, values=list(MOTORES_CLAHE), state='readonly', width=10)
+        cb_clahe.grid(row=row, column=1, sticky='w', pady=5)
+        cb_clahe.bind("<<ComboboxSelected>>", lambda e: self.save_changes())
+        row += 1
+
         Separator(self, orient='horizontal').grid(row=row, column=0, columnspan=3, sticky='ew', padx=40, pady=20)
         row += 1
         Button(self, text="< Voltar", width=20, command=lambda: controller.show_frame("StartPage")).grid(row=row, column=1, pady=10)
@@ -447,8 +2169,186 @@ class SettingsPage(Frame):
         self.controller.settings["fullscreen"] = self.var_fullscreen.get()
         self.controller.settings["remember_last_dir"] = self.var_remember.get()
         self.controller.settings["default_dir"] = self.var_default_dir.get()
+        try:
+            self.controller.settings["pipeline_queue_depth"] = max(1, int(self.var_queue_depth.get()))
+            self.controller.settings["gdal_cache_mb"] = max(16, int(self.var_gdal_cache.get()))
+        except (tk.TclError, ValueError):
+            pass
+        threads = self.var_gdal_threads.get().strip().upper()
+        if threads == "ALL_CPUS" or threads.isdigit():
+            self.controller.settings["gdal_num_threads"] = threads
+        self.controller.settings["gdal_overview_policy"] = self.var_gdal_overviews.get()
+        self.controller.settings["clahe_engine"] = self.var_clahe_engine.get()
+        definir_motor_clahe(self.var_clahe_engine.get())
         self.controller.save_settings()
 
+def construir_piramide(imagem, tamanho_min=VIEWER_TILE):
+    # Nível 0 = resolução total; cada nível seguinte tem metade do lado, até caber em um tile
+    niveis = [imagem.convert("RGB")]
+    while max(niveis[-1].size) > tamanho_min:
+        niveis.append(niveis[-1].reduce(2))
+    return niveis
+
+class VisualizadorResultado(tk.Toplevel):
+    """Janela com pan (arrastar) e zoom (roda do mouse, +/-, 0 = ajustar) sobre uma pirâmide de tiles.
+
+    A cada redesenho só os tiles visíveis do nível adequado ao zoom são recortados e
+    convertidos em PhotoImage; os tiles ficam num cache LRU de tamanho fixo.
+    """
+    def __init__(self, parent, piramide, titulo="Resultado da Análise"):
+        super().__init__(parent)
+        self.title(titulo)
+        self.geometry("900x700")
+        self.configure(bg='#0a0a0a')
+
+        self.piramide = piramide
+        self.largura, self.altura = piramide[0].size
+        self.cache_tiles = OrderedDict()
+        self.pixels_cache = 0
+        self.tiles_visiveis = []  # Referências dos tiles na tela (podem já ter saído do cache)
+        self.escala = 1.0
+        self.ox = 0.0  # coordenadas (nível 0) do canto superior esquerdo da vista
+        self.oy = 0.0
+        self._arraste = None
+        self._redesenho_agendado = False
+        self._ajustado = False
+
+        self.canvas = tk.Canvas(self, bg='#191919', highlightthickness=0)
+        self.canvas.pack(fill="both", expand=True)
+
+        self.canvas.bind("<Configure>", self._on_configure)
+        self.canvas.bind("<ButtonPress-1>", self._on_press)
+        self.canvas.bind("<B1-Motion>", self._on_drag)
+        self.canvas.bind("<MouseWheel>", self._on_wheel)
+        self.canvas.bind("<Button-4>", lambda e: self._zoom(1.25, e.x, e.y))
+        self.canvas.bind("<Button-5>", lambda e: self._zoom(0.8, e.x, e.y))
+        self.bind("<plus>", lambda e: self._zoom(1.25))
+        self.bind("<KP_Add>", lambda e: self._zoom(1.25))
+        self.bind("<minus>", lambda e: self._zoom(0.8))
+        self.bind("<KP_Subtract>", lambda e: self._zoom(0.8))
+        self.bind("<Key-0>", lambda e: self.ajustar())
+
+    def substituir(self, piramide):
+        # Troca a imagem (ex.: prévia -> resultado completo) mantendo a mesma região em vista
+        r = piramide[0].size[0] / self.largura
+        self.piramide = piramide
+        self.largura, self.altura = piramide[0].size
+        self.cache_tiles.clear()
+        self.pixels_cache = 0
+        self.escala /= r
+        self.ox *= r
+        self.oy *= r
+        self.agendar_redesenho()
+
+    def _escala_ajuste(self):
+        cw = max(1, self.canvas.winfo_width())
+        ch = max(1, self.canvas.winfo_height())
+        return min(cw / self.largura, ch / self.altura)
+
+    def ajustar(self):
+        self.escala = self._escala_ajuste()
+        cw, ch = self.canvas.winfo_width(), self.canvas.winfo_height()
+        self.ox = -(cw / self.escala - self.largura) / 2
+        self.oy = -(ch / self.escala - self.altura) / 2
+        self.agendar_redesenho()
+
+    def _on_configure(self, event):
+        if not self._ajustado:
+            self._ajustado = True
+            self.ajustar()
+        else:
+            self.agendar_redesenho()
+
+    def _on_press(self, event):
+        self._arraste = (event.x, event.y, self.ox, self.oy)
+
+    def _on_drag(self, event):
+        if self._arraste is None: return
+        x0, y0, ox0, oy0 = self._arraste
+        self.ox = ox0 - (event.x - x0) / self.escala
+        self.oy = oy0 - (event.y - y0) / self.escala
+        self.agendar_redesenho()
+
+    def _on_wheel(self, event):
+        self._zoom(1.25 if event.delta > 0 else 0.8, event.x, event.y)
+
+    def _zoom(self, fator, cx=None, cy=None):
+        if cx is None:
+            cx, cy = self.canvas.winfo_width() / 2, self.canvas.winfo_height() / 2
+        # Arredonda para o passo discreto mais próximo: a escala (e a chave dos tiles) se repete entre zooms
+        passo = round(math.log2(self.escala * fator) * VIEWER_PASSOS_OITAVA)
+        if passo == round(math.log2(self.escala) * VIEWER_PASSOS_OITAVA):
+            passo += 1 if fator > 1 else -1
+        nova = min(VIEWER_ZOOM_MAX, max(self._escala_ajuste() / 2, 2 ** (passo / VIEWER_PASSOS_OITAVA)))
+        # Mantém fixo o ponto da imagem sob o cursor
+        px = self.ox + cx / self.escala
+        py = self.oy + cy / self.escala
+        self.escala = nova
+        self.ox = px - cx / nova
+        self.oy = py - cy / nova
+        self.agendar_redesenho()
+
+    def agendar_redesenho(self):
+        # Agrupa vários eventos de pan/zoom num único redesenho
+        if not self._redesenho_agendado:
+            self._redesenho_agendado = True
+            self.after_idle(self._redesenhar)
+
+    def _tile(self, nivel, f, tx, ty):
+        # Tamanho na tela derivado só da grade do nível e da escala (não do pan): a chave se mantém ao arrastar
+        img = self.piramide[nivel]
+        chave = (nivel, round(f, 6), tx, ty)
+        foto = self.cache_tiles.get(chave)
+        if foto is not None:
+            self.cache_tiles.move_to_end(chave)
+            return foto
+        caixa = (tx * VIEWER_TILE, ty * VIEWER_TILE,
+                 min(img.width, (tx + 1) * VIEWER_TILE), min(img.height, (ty + 1) * VIEWER_TILE))
+        w = round(caixa[2] * f) - round(caixa[0] * f)
+        h = round(caixa[3] * f) - round(caixa[1] * f)
+        if w <= 0 or h <= 0: return None
+        tile = img.crop(caixa)
+        if tile.size != (w, h):
+            tile = tile.resize((w, h), Image.BILINEAR)
+        foto = ImageTk.PhotoImage(tile)
+        self.cache_tiles[chave] = foto
+        self.pixels_cache += w * h
+        # LRU limitado por pixels (memória), não por quantidade de tiles
+        while self.pixels_cache > VIEWER_CACHE_PIXELS and len(self.cache_tiles) > 1:
+            _, antiga = self.cache_tiles.popitem(last=False)
+            self.pixels_cache -= antiga.width() * antiga.height()
+        return foto
+
+    def _redesenhar(self):
+        self._redesenho_agendado = False
+        cw, ch = self.canvas.winfo_width(), self.canvas.winfo_height()
+
+        # Nível mais grosso cuja resolução ainda é >= a da tela
+        nivel = 0
+        while nivel + 1 < len(self.piramide) and self.escala * (2 ** (nivel + 1)) <= 1.0:
+            nivel += 1
+        img = self.piramide[nivel]
+        f = self.escala * (2 ** nivel)  # pixels de tela por pixel do nível
+        ox_n, oy_n = self.ox / (2 ** nivel), self.oy / (2 ** nivel)
+        dx, dy = round(ox_n * f), round(oy_n * f)
+
+        tx0 = max(0, int(ox_n // VIEWER_TILE))
+        ty0 = max(0, int(oy_n // VIEWER_TILE))
+        tx1 = min((img.width - 1) // VIEWER_TILE, int((ox_n + cw / f) // VIEWER_TILE))
+        ty1 = min((img.height - 1) // VIEWER_TILE, int((oy_n + ch / f) // VIEWER_TILE))
+
+        self.canvas.delete("tile")
+        visiveis = []
+        for ty in range(ty0, ty1 + 1):
+            for tx in range(tx0, tx1 + 1):
+                foto = self._tile(nivel, f, tx, ty)
+                if foto is None: continue
+                visiveis.append(foto)
+                x0 = round(tx * VIEWER_TILE * f) - dx
+                y0 = round(ty * VIEWER_TILE * f) - dy
+                self.canvas.create_image(x0, y0, image=foto, anchor="nw", tags="tile")
+        self.tiles_visiveis = visiveis
+
 class ManualPage(Frame):
     def __init__(self, parent, controller):
         super().__init__(parent)
@@ -458,6 +2358,14 @@ class ManualPage(Frame):
         self.is_processing = False
         self.last_image = None
         self.img_tk = None
+        self._piramide = None
+        self._visualizador = None
+        # Cada mudança de entradas incrementa a geração; resultados de gerações antigas são descartados
+        self._geracao = 0
+        self._resultados = queue.Queue()
+        # Uma única thread de processamento; só a tarefa mais recente da fila é executada
+        self._tarefas = queue.Queue()
+        self._trabalhador = None
 
         self.grid_columnconfigure(0, weight=1) 
         self.grid_columnconfigure(1, weight=1) 
@@ -484,7 +2392,7 @@ class ManualPage(Frame):
         # Inputs
         self.build_input_group("Shapefile da Parcela (alvo - *.shp):", "Selecionar Parcela", self.v_shp_par, "shp_par", [("Shapefile", "*.shp")], VAR_COLOR)
         self.build_input_group("Shapefile de Contexto (Área Geral - *.shp):", "Selecionar Contexto", self.v_shp_ctx, "shp_ctx", [("Shapefile", "*.shp")], VAR_COLOR)
-        self.build_input_group("Imagem TIFF (Mosaico/Ortofoto - *.tif/*.tiff):", "Selecionar TIFF", self.v_rast, "rast", [("Tiff", "*.tif *.tiff")], VAR_COLOR)
+        self.build_input_group("Imagem TIFF (Mosaico/Ortofoto ou tiles - *.tif/*.tiff):", "Selecionar TIFF(s)", self.v_rast, "rast", [("Tiff", "*.tif *.tiff")], VAR_COLOR)
         
 
         # Observadores automáticos
@@ -492,6 +2400,9 @@ class ManualPage(Frame):
         self.v_shp_ctx.trace_add("write", self._on_inputs_changed)
         self.v_rast.trace_add("write", self._on_inputs_changed)
 
+        self.v_status = tk.StringVar()
+        Label(self, textvariable=self.v_status, foreground='#007acc').grid(row=self.current_row, column=1, pady=(10, 0))
+        self.current_row += 1
         
         # Botões finais
         Button(
@@ -536,47 +2447,110 @@ class ManualPage(Frame):
         if path:
             var.set(path)
     def _on_inputs_changed(self, *args):
-        if self.is_processing:
-            return
+        # Qualquer processamento em andamento passa a ser obsoleto (é cancelado na próxima etapa)
+        self._geracao += 1
+        self.last_image = None
 
-        if not all([
-            self.v_shp_par.get(),
-            self.v_shp_ctx.get(),
-            self.v_rast.get()
-        ]):
+        if not (self.v_shp_ctx.get() and self.v_rast.get()):
+            self.is_processing = False
+            self.v_status.set("")
+            self.preview_label.config(image='', text="Selecione TIFF e Contexto", style='Preview.TLabel')
+            self.img_tk = None
             return
 
-        self.is_processing = True
-        self.after(100, self._processar_auto)
-    def _processar_auto(self):
+        geracao = self._geracao
+        self.after(100, lambda: self._processar_auto(geracao))
+    def _processar_auto(self, geracao):
+        # Várias mudanças seguidas disparam um único processamento
+        if geracao != self._geracao: return
+
+        entradas = (self.v_rast.get(), self.v_shp_par.get(), self.v_shp_ctx.get())
+        # Com as 3 entradas: prévia rápida + figura completa; só TIFF e contexto: miniatura do contexto
+        tipo = "analise" if all(entradas) else "contexto"
+        self._tarefas.put((geracao, tipo, entradas, opcoes_gdal(self.controller.settings)))
+        if self._trabalhador is None:
+            self._trabalhador = threading.Thread(target=self._laco_processamento, daemon=True)
+            self._trabalhador.start()
+        self.v_status.set("Gerando prévia rápida..." if tipo == "analise" else "Carregando contexto...")
+        if not self.is_processing:
+            self.is_processing = True
+            self.after(PREVIA_INTERVALO_MS, self._consultar_resultados)
+    def _laco_processamento(self):
+        while True:
+            tarefa = self._tarefas.get()
+            # Tarefas acumuladas enquanto a anterior rodava já são obsoletas, exceto a última
+            while True:
+                try: tarefa = self._tarefas.get_nowait()
+                except queue.Empty: break
+            self._processar_em_segundo_plano(*tarefa)
+    def _processar_em_segundo_plano(self, geracao, tipo, entradas, opcoes):
+        # Prévia (leitura decimada, sem CLAHE) e depois a figura completa; roda fora da thread do Tk
+        cancelado = lambda: geracao != self._geracao
         try:
-            tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-            tmp.close()
-            self.last_image = processar_logica_geral(
-                self.v_rast.get(),
-                self.v_shp_par.get(),
-                self.v_shp_ctx.get(),
-            )
-
+            if tipo == "contexto":
+                self._resultados.put((geracao, "contexto", gerar_previa_contexto(*entradas, opcoes, cancelado)))
+                return
+            for etapa, rapido in (("previa", True), ("final", False)):
+                verificar_cancelamento(cancelado)
+                imagem = processar_logica_geral(*entradas, opcoes, cancelado=cancelado, rapido=rapido)
+                self._resultados.put((geracao, etapa, imagem))
+        except ProcessamentoCancelado:
+            pass
         except Exception as e:
-            messagebox.showerror("Erro", f"Falha no processamento:\n{e}")
+            self._resultados.put((geracao, "erro", e))
+    def _consultar_resultados(self):
+        try:
+            while True:
+                geracao, etapa, valor = self._resultados.get_nowait()
+                if geracao != self._geracao: continue
+                if etapa == "erro":
+                    self.is_processing = False
+                    self.v_status.set("")
+                    self.preview_label.config(image='', text=f"Erro: {valor}", style='Preview.TLabel', foreground='red')
+                    self.img_tk = None
+                    messagebox.showerror("Erro", f"Falha no processamento:\n{valor}")
+                    continue
+                if etapa == "contexto":
+                    self.is_processing = False
+                    self.v_status.set("")
+                    self._exibir_miniatura(valor)
+                    continue
+                self.last_image = valor
+                self._exibir_resultado()
+                if etapa == "previa":
+                    self.v_status.set("Prévia (baixa resolução) - refinando em segundo plano...")
+                else:
+                    self.is_processing = False
+                    self.v_status.set("Resultado completo")
+        except queue.Empty:
+            pass
 
-        finally:
-            self.is_processing = False
+        if self.is_processing:
+            self.after(PREVIA_INTERVALO_MS, self._consultar_resultados)
+    def _exibir_miniatura(self, imagem):
+        img = imagem.copy()
+        img.thumbnail((200, 200))
+        self.img_tk = ImageTk.PhotoImage(img)
+        self.preview_label.config(image=self.img_tk, text="", style='TLabel')
+    def _exibir_resultado(self):
+        self._exibir_miniatura(self.last_image)
+        if self._visualizador is not None and self._visualizador.winfo_exists():
+            self._visualizador.substituir(self._piramide_atual())
+    def _piramide_atual(self):
+        # A pirâmide é construída uma única vez por resultado
+        if self._piramide is None or self._piramide[0] is not self.last_image:
+            self._piramide = (self.last_image, construir_piramide(self.last_image))
+        return self._piramide[1]
     def mostrar_imagem(self):
         if not self.last_image:
             messagebox.showinfo("Aviso", "Nenhuma imagem para visualizar.")
             return
 
-        top = tk.Toplevel(self)
-        top.title("Resultado da Análise")
-        top.geometry("900x700")
-
-        img = self.last_image.copy()
-        img.thumbnail((850, 650), Image.LANCZOS)
-
-        self._img_tk = ImageTk.PhotoImage(img)
-        Label(top, image=self._img_tk).pack(expand=True)
+        if self._visualizador is not None and self._visualizador.winfo_exists():
+            self._visualizador.substituir(self._piramide_atual())
+            self._visualizador.lift()
+            return
+        self._visualizador = VisualizadorResultado(self, self._piramide_atual())
     def salvar_imagem(self):
         if not self.last_image:
             messagebox.showwarning("Aviso", "Nenhuma imagem gerada.")
@@ -590,73 +2564,6 @@ class ManualPage(Frame):
         if save_path:
             self.last_image.save(save_path)
             messagebox.showinfo("Sucesso", "Imagem salva com sucesso.")
-    def update_tif_preview(self):
-        shp_par_path = self.v_shp_par.get()
-        shp_ctx_path = self.v_shp_ctx.get()
-        rast_path = self.v_rast.get()
-
-        if not shp_ctx_path or not rast_path:
-            self.preview_label.config(image='', text="Selecione TIFF e Contexto", style='Preview.TLabel')
-            self.img_tk = None
-            return
-
-        self.preview_label.config(image='', text="Carregando...", style='Preview.TLabel', foreground='#007acc')
-        self.update_idletasks()
-
-        try:
-            with rasterio.open(rast_path) as src:
-                if src.count < 3: raise ValueError("Raster precisa de 3 bandas (RGB).")
-                
-                gdf_ctx = gpd.read_file(shp_ctx_path).to_crs(src.crs)
-                geom_ctx = [mapping(unary_union(gdf_ctx.geometry))]
-                
-                if shp_par_path and os.path.exists(shp_par_path):
-                    gdf_par = gpd.read_file(shp_par_path).to_crs(src.crs)
-                else:
-                    gdf_par = None
-                    
-                recorte, out_transform = rasterio.mask.mask(
-                    src, geom_ctx, crop=True, filled=True, nodata=0, indexes=BANDAS_LEITURA
-                )
-                
-                R = recorte[2].astype(np.float32); R[R == 0] = np.nan
-                G = recorte[1].astype(np.float32); G[G == 0] = np.nan
-                B = recorte[0].astype(np.float32); B[B == 0] = np.nan
-                rgb_ctx_norm = np.dstack((normalize_visual(R), normalize_visual(G), normalize_visual(B)))
-
-                out_bounds = array_bounds(recorte.shape[1], recorte.shape[2], out_transform)
-                extent = (out_bounds[0], out_bounds[2], out_bounds[1], out_bounds[3])
-
-                fig, ax = plt.subplots(figsize=(4, 4)) 
-                ax.imshow(rgb_ctx_norm, extent=extent, vmin=0, vmax=255) 
-                ax.axis('off')
-
-                if gdf_par is not None:
-                    gdf_par.boundary.plot(ax=ax, color='red', linewidth=3)
-                    
-                ax.set_xlim(extent[0], extent[1])
-                ax.set_ylim(extent[2], extent[3])
-                
-                plt.tight_layout(pad=0)
-                buf = io.BytesIO()
-                fig.savefig(buf, format='png', bbox_inches='tight', pad_inches=0)
-                plt.close(fig)
-                
-                buf.seek(0)
-                img = Image.open(buf)
-                img.thumbnail((200, 200))
-                tk_img = ImageTk.PhotoImage(img)
-                
-                self.img_tk = tk_img 
-                self.preview_label.config(image=self.img_tk, text="", style='TLabel')
-                preview_path = os.path.join("temp", "preview.png")
-                fig.savefig(preview_path, dpi=150, bbox_inches="tight")
-                
-        except Exception as e:
-            msg = f"Erro: {str(e)}"
-            self.preview_label.config(image='', text=msg, style='Preview.TLabel', foreground='red')
-            self.img_tk = None
-
     def build_input_group(self, label_text, button_text, var_control, dir_key, filetypes, var_color):
         row = self.current_row 
         Label(self, text=label_text).grid(row=row, column=0, columnspan=2, pady=(5,0)) 
@@ -670,6 +2577,9 @@ class ManualPage(Frame):
 
             if key == 'folder':
                 path = filedialog.askdirectory(initialdir=initial_dir)
+            elif key == 'rast':
+                # Vários tiles selecionados formam um mosaico virtual ("a.tif;b.tif")
+                path = MOSAICO_SEPARADOR.join(filedialog.askopenfilenames(initialdir=initial_dir, filetypes=filetypes))
             else:
                 path = filedialog.askopenfilename(initialdir=initial_dir, filetypes=filetypes)
             
@@ -692,10 +2602,8 @@ class ManualPage(Frame):
                 target_var.set(path)
                 
                 if self.controller.settings.get("remember_last_dir", True):
-                    self.controller.update_last_dir(key, path)
-                
-                if hasattr(self, 'update_tif_preview') and key in ['rast', 'shp_ctx', 'shp_par']:
-                    self.update_tif_preview()
+                    self.controller.update_last_dir(key, arquivos_raster(path)[0] if key == 'rast' else path)
+
 
         Button(self, text=button_text, command=open_dialog, width=15).grid(row=row, column=1, pady=2)
         row += 1
@@ -703,33 +2611,6 @@ class ManualPage(Frame):
         row += 1
         self.current_row = row 
 
-    def run_manual(self):
-        shp_par = self.v_shp_par.get()
-        shp_ctx = self.v_shp_ctx.get()
-        rast = self.v_rast.get()
-
-        if not all([shp_par, shp_ctx, rast]):
-            messagebox.showwarning("Aviso", "Preencha os 3 campos antes de processar.")
-            return
-
-        try:
-            self.controller.update_idletasks()
-
-            imagem = processar_logica_geral(
-                rast,
-                shp_par,
-                shp_ctx
-            )
-
-            # Guarda imagem em memória
-            self.last_image = imagem
-
-            # Mostra automaticamente
-            self.mostrar_imagem(imagem)
-
-        except Exception as e:
-            messagebox.showerror("Erro", str(e))
-
 class AutomaticPage(Frame):
     def __init__(self, parent, controller):
         super().__init__(parent, style='TFrame')
@@ -751,11 +2632,21 @@ class AutomaticPage(Frame):
 
         self.build_input_group("Pasta com Parcelas (*.shp):", "Selecionar Pasta", self.v_folder, "folder", [], VAR_COLOR) 
         self.build_input_group("Shapefile de Contexto (Área Geral - *.shp):", "Selecionar Contexto", self.v_shp_ctx, "shp_ctx", [("Shapefile", "*.shp")], VAR_COLOR)
-        self.build_input_group("Imagem TIFF (Mosaico/Ortofoto - *.tif/*.tiff):", "Selecionar TIFF", self.v_rast, "rast", [("Tiff", "*.tif *.tiff")], VAR_COLOR)
+        self.build_input_group("Imagem TIFF (Mosaico/Ortofoto ou tiles - *.tif/*.tiff):", "Selecionar TIFF(s)", self.v_rast, "rast", [("Tiff", "*.tif *.tiff")], VAR_COLOR)
         
-        cb = Checkbutton(self, text="Salvar relatório CSV consolidado (por parcela)", variable=tk.IntVar(value=0), style='TCheckbutton')
-        cb.grid(row=self.current_row, column=1, pady=(12,0), sticky='w')
         self.v_savecsv = tk.IntVar(value=0) 
+        cb = Checkbutton(self, text="Salvar relatório CSV consolidado (por parcela)", variable=self.v_savecsv, style='TCheckbutton')
+        cb.grid(row=self.current_row, column=1, pady=(12,0), sticky='w')
+        self.current_row += 1
+
+        self.v_somente_stats = tk.IntVar(value=0)
+        cb_stats = Checkbutton(self, text="Somente estatísticas (CSV, sem gerar imagens)", variable=self.v_somente_stats, style='TCheckbutton')
+        cb_stats.grid(row=self.current_row, column=1, pady=(4,0), sticky='w')
+        self.current_row += 1
+
+        self.v_salvar_pixels = tk.IntVar(value=0)
+        cb_pixels = Checkbutton(self, text="Salvar pixels para recalibração (armazem_pixels)", variable=self.v_salvar_pixels, style='TCheckbutton')
+        cb_pixels.grid(row=self.current_row, column=1, pady=(4,0), sticky='w')
         self.current_row += 1
 
         Label(self, text="Progresso:").grid(row=self.current_row, column=1, pady=(10,0))
@@ -785,6 +2676,9 @@ class AutomaticPage(Frame):
 
             if key == 'folder':
                 path = filedialog.askdirectory(initialdir=initial_dir)
+            elif key == 'rast':
+                # Vários tiles selecionados formam um mosaico virtual ("a.tif;b.tif")
+                path = MOSAICO_SEPARADOR.join(filedialog.askopenfilenames(initialdir=initial_dir, filetypes=filetypes))
             else:
                 path = filedialog.askopenfilename(initialdir=initial_dir, filetypes=filetypes)
             
@@ -801,7 +2695,7 @@ class AutomaticPage(Frame):
 
                 target_var.set(path)
                 if self.controller.settings.get("remember_last_dir", True):
-                    self.controller.update_last_dir(key, path)
+                    self.controller.update_last_dir(key, arquivos_raster(path)[0] if key == 'rast' else path)
 
         Button(self, text=button_text, command=open_dialog, width=28).grid(row=row, column=1, pady=2)
         row += 1
@@ -813,76 +2707,66 @@ class AutomaticPage(Frame):
         folder = self.v_folder.get()
         shp_ctx = self.v_shp_ctx.get()
         raster = self.v_rast.get()
-        save_csv_flag = bool(self.v_savecsv.get())
+        somente_stats = bool(self.v_somente_stats.get())
+        save_csv_flag = bool(self.v_savecsv.get()) or somente_stats
 
-        if not all([folder, shp_ctx, raster]):
+        # O contexto só é usado na figura: dispensável no modo somente estatísticas
+        if not all([folder, raster]) or not (shp_ctx or somente_stats):
             messagebox.showwarning("Aviso", "Preencha todos os campos antes de iniciar o lote.")
             return
 
         try:
-            arquivos = sorted([f for f in os.listdir(folder) if f.lower().endswith(".shp")],
-                              key=lambda x: (extract_parcela_number(x) if extract_parcela_number(x) is not None else 9999, x))
+            opcoes = opcoes_gdal(self.controller.settings)
+            arquivos, fora = selecionar_parcelas(folder, raster, opcoes)
+            if fora:
+                print(f"{len(fora)} parcela(s) fora da área do raster, ignoradas: {', '.join(fora)}")
             total = len(arquivos)
             if total == 0:
-                messagebox.showwarning("Aviso", "Nenhum arquivo .shp encontrado na pasta selecionada.")
+                if fora:
+                    messagebox.showwarning("Aviso", f"Todas as {len(fora)} parcelas estão fora da área do raster selecionado.")
+                else:
+                    messagebox.showwarning("Aviso", "Nenhum arquivo .shp encontrado na pasta selecionada.")
                 return
 
-            csv_rows = []
             self.v_prog.set(0)
-            
-            for i, shp in enumerate(arquivos):
-                full_shp = os.path.join(folder, shp)
-                out_png = os.path.join(folder, f"Resultado_{os.path.splitext(shp)[0]}.png")
 
-                try:
-                    processar_logica_geral(raster, full_shp, shp_ctx, save_path=out_png, show_plot=False)
-                except Exception as e:
-                    print(f"Erro processando {shp}: {e}")
-                
-                if save_csv_flag:
-                    try:
-                        with rasterio.open(raster) as ds:
-                            gdf_par = gpd.read_file(full_shp).to_crs(ds.crs)
-                            geom = [mapping(unary_union(gdf_par.geometry))]
-                            rec, _ = rasterio.mask.mask(ds, geom, crop=True, filled=True, nodata=0, indexes=BANDAS_LEITURA)
-                            rec = rec.astype(np.float32)
-                            R = rec[2]; G = rec[1]; B = rec[0]
-                            R[R==0] = np.nan; G[G==0] = np.nan; B[B==0] = np.nan
-                            
-                            with np.errstate(divide='ignore', invalid='ignore'):
-                                NIR_est = (COEF_A - G) / COEF_B
-                                NDVI = (NIR_est - R) / (NIR_est + R + 1e-9)
-                            
-                            def stats(arr):
-                                valid = arr[~np.isnan(arr)]
-                                if valid.size == 0: return [np.nan]*7
-                                return [float(np.nanmean(valid)), float(np.nanmedian(valid)), float(np.nanstd(valid)),
-                                        float(np.nanmin(valid)), float(np.nanmax(valid)),
-                                        float(np.nanpercentile(valid,25)), float(np.nanpercentile(valid,75))]
-                                        
-                            r_stats = stats(R); g_stats = stats(G); b_stats = stats(B); ndvi_stats = stats(NDVI)
-                            row = {"Parcela": os.path.splitext(shp)[0]}
-                            row.update({f"R_{k}": v for k,v in zip(["mean","median","std","min","max","p25","p75"], r_stats)})
-                            row.update({f"G_{k}": v for k,v in zip(["mean","median","std","min","max","p25","p75"], g_stats)})
-                            row.update({f"B_{k}": v for k,v in zip(["mean","median","std","min","max","p25","p75"], b_stats)})
-                            row.update({f"NDVI_{k}": v for k,v in zip(["mean","median","std","min","max","p25","p75"], ndvi_stats)})
-                            csv_rows.append(row)
-                    except Exception as e:
-                        print(f"Erro stats {shp}: {e}")
-
-                self.v_prog.set(int((i+1)/total * 100))
+            def ao_progredir(n):
+                self.v_prog.set(int(n/total * 100))
                 self.update_idletasks()
 
+            profundidade = self.controller.settings.get("pipeline_queue_depth", PIPELINE_PROFUNDIDADE_PADRAO)
+            armazem = ArmazemPixels.criar(os.path.join(folder, ARMAZEM_PIXELS_DIR)) if self.v_salvar_pixels.get() else None
+            try:
+                if somente_stats:
+                    rel, csv_rows = processar_estatisticas_lote(
+                        folder, arquivos, raster,
+                        opcoes=opcoes, profundidade=profundidade, ao_progredir=ao_progredir,
+                        armazem=armazem
+                    )
+                else:
+                    rel, csv_rows = processar_lote(
+                        folder, arquivos, raster, shp_ctx,
+                        salvar_csv=save_csv_flag,
+                        opcoes=opcoes,
+                        profundidade=profundidade,
+                        ao_progredir=ao_progredir,
+                        armazem=armazem
+                    )
+            finally:
+                if armazem is not None: armazem.fechar()
+            resumo = formatar_relatorio_pipeline(rel)
+            print("Pipeline:", resumo)
+            if fora:
+                resumo += f"\n\nFora da área do raster ({len(fora)}): {', '.join(fora)}"
+
             if save_csv_flag and csv_rows:
                 try:
-                    df = pd.DataFrame(csv_rows)
-                    csv_out = os.path.join(folder, "relatorio_consolidado_parcelas.csv")
-                    df.to_csv(csv_out, index=False, float_format="%.6f")
-                    messagebox.showinfo("Concluído", f"Lote finalizado. CSV salvo em:\n{csv_out}")
+                    csv_out = salvar_relatorio_csv(csv_rows, folder)
+                    messagebox.showinfo("Concluído", f"Lote finalizado. CSV salvo em:\n{csv_out}\n\n{resumo}")
                 except Exception as e:
                     messagebox.showwarning("Aviso", f"Lote finalizado. Falha ao salvar CSV: {e}")
             else:
-                messagebox.showinfo("Concluído", f"Lote finalizado. {total} parcelas processadas.")
+                messagebox.showinfo("Concluído", f"Lote finalizado. {total} parcelas processadas.\n\n{resumo}")
             
             # SALVA SETTINGS APÓS SUCESSO
             self.controller.save_settings()
@@ -892,6 +2776,97 @@ class AutomaticPage(Frame):
             print(traceback.format_exc())
             messagebox.showerror("Erro Fatal", f"Erro durante processamento em lote:\n{e}")
 
+# =========================
+# LINHA DE COMANDO
+# =========================
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Processador de NDVI & NIR. Sem argumentos, abre a interface gráfica.")
+    parser.add_argument("--lote", metavar="PASTA", help="Pasta com os shapefiles 'Parcela N.shp'")
+    parser.add_argument("--raster", metavar="TIFF",
+                        help=f"Imagem TIFF (mosaico/ortofoto), pasta de tiles ou tiles separados por \"{MOSAICO_SEPARADOR}\"")
+    parser.add_argument("--contexto", metavar="SHP", help="Shapefile de contexto (área geral)")
+    parser.add_argument("--somente-estatisticas", action="store_true",
+                        help="Calcula apenas as estatísticas R/G/B/NDVI (CSV), sem gerar imagens")
+    parser.add_argument("--csv", action="store_true", help="Salva o relatório CSV consolidado junto com as imagens")
+    parser.add_argument("--vigiar", metavar="PASTA", help="Modo vigia: monitora esta pasta de parcelas continuamente")
+    parser.add_argument("--pasta-rasters", metavar="PASTA", help="Modo vigia: pasta monitorada com os TIFFs dos voos")
+    parser.add_argument("--saida", metavar="PASTA", help="Modo vigia: pasta dos PNGs, relatório e status (padrão: a pasta de parcelas)")
+    parser.add_argument("--workers", type=int, help="Modo vigia/serviço: número de processos de trabalho")
+    parser.add_argument("--intervalo", type=float, default=VIGIA_INTERVALO_S, help="Modo vigia: segundos entre varreduras")
+    parser.add_argument("--salvar-pixels", action="store_true",
+                        help=f"Lote: guarda os pixels R/G e a máscara de cada parcela em PASTA/{ARMAZEM_PIXELS_DIR}")
+    parser.add_argument("--recalibrar", metavar="ARMAZEM",
+                        help="Recalcula NIR/NDVI/estatísticas/MVLF a partir de um armazém de pixels, sem ler raster nem shapefiles")
+    parser.add_argument("--coef-a", type=float, default=COEF_A, help="Recalibração: coeficiente A do NIR estimado")
+    parser.add_argument("--coef-b", type=float, default=COEF_B, help="Recalibração: coeficiente B do NIR estimado")
+    parser.add_argument("--mvlf-angular", type=float, default=MVLF_COEF_ANGULAR, help="Recalibração: coeficiente angular da regressão MVLF")
+    parser.add_argument("--mvlf-intercepto", type=float, default=MVLF_INTERCEPTO, help="Recalibração: intercepto da regressão MVLF")
+    parser.add_argument("--clahe", choices=MOTORES_CLAHE,
+                        help="Motor do CLAHE nas imagens (padrão: o das configurações)")
+    parser.add_argument("--servir", action="store_true", help="Inicia o serviço HTTP local de processamento")
+    parser.add_argument("--host", default=SERVICO_HOST, help="Serviço HTTP: endereço de escuta")
+    parser.add_argument("--porta", type=int, default=SERVICO_PORTA, help="Serviço HTTP: porta")
+    args = parser.parse_args(argv)
+    definir_motor_clahe(args.clahe or carregar_settings().get("clahe_engine", CLAHE_MOTOR_PADRAO))
+
+    if args.recalibrar:
+        t0 = time.perf_counter()
+        rows = recalibrar_armazem(args.recalibrar, args.coef_a, args.coef_b, args.mvlf_angular, args.mvlf_intercepto)
+        csv_out = os.path.join(args.recalibrar, "relatorio_recalibrado.csv")
+        pd.DataFrame(rows).to_csv(csv_out, index=False, float_format="%.6f")
+        print(f"{len(rows)} parcelas recalibradas em {time.perf_counter() - t0:.2f}s. CSV salvo em: {csv_out}")
+        return 0
+
+    if args.servir:
+        servico = ServicoProcessamento(args.host, args.porta, n_workers=args.workers,
+                                       opcoes=opcoes_gdal(carregar_settings()))
+        servico.executar()
+        return 0
+
+    if args.vigiar:
+        if not args.pasta_rasters:
+            parser.error("--vigiar requer --pasta-rasters")
+        vigia = VigiaPastas(args.vigiar, args.pasta_rasters, args.saida or args.vigiar,
+                            shp_contexto=args.contexto, opcoes=opcoes_gdal(carregar_settings()),
+                            n_workers=args.workers, intervalo=args.intervalo,
+                            somente_stats=args.somente_estatisticas)
+        vigia.executar()
+        return 0
+
+    if not args.lote:
+        app = App()
+        app.mainloop()
+        return 0
+
+    if not args.raster or not (args.contexto or args.somente_estatisticas):
+        parser.error("--lote requer --raster e --contexto (ou --somente-estatisticas)")
+
+    settings = carregar_settings()
+    opcoes = opcoes_gdal(settings)
+    profundidade = settings.get("pipeline_queue_depth", PIPELINE_PROFUNDIDADE_PADRAO)
+    arquivos, fora = selecionar_parcelas(args.lote, args.raster, opcoes)
+    if fora:
+        print(f"{len(fora)} parcela(s) fora da área do raster, ignoradas: {', '.join(fora)}")
+    if not arquivos:
+        print("Nenhuma parcela a processar na pasta selecionada.")
+        return 1
+
+    armazem = ArmazemPixels.criar(os.path.join(args.lote, ARMAZEM_PIXELS_DIR)) if args.salvar_pixels else None
+    try:
+        if args.somente_estatisticas:
+            rel, csv_rows = processar_estatisticas_lote(args.lote, arquivos, args.raster, opcoes=opcoes,
+                                                        profundidade=profundidade, armazem=armazem)
+        else:
+            rel, csv_rows = processar_lote(args.lote, arquivos, args.raster, args.contexto,
+                                           salvar_csv=args.csv, opcoes=opcoes, profundidade=profundidade,
+                                           armazem=armazem)
+    finally:
+        if armazem is not None: armazem.fechar()
+    print("Pipeline:", formatar_relatorio_pipeline(rel))
+    if csv_rows:
+        print("CSV salvo em:", salvar_relatorio_csv(csv_rows, args.lote))
+    return 0
+
 if __name__ == "__main__":
-    app = App()
-    app.mainloop()
\ No newline at end of file
+    multiprocessing.freeze_support()  # necessário para o pool de processos no executável PyInstaller
+    raise SystemExit(main())
\ No newline at end of file